@@ -0,0 +1,67 @@
+import os
+import json
+import uuid
+import hashlib
+
+import numpy as np
+
+
+class FeatureCache:
+    """Directory of compressed .npz files with the prepared (featurized)
+    instances of annotated XML files (see junk_remover.prepare_xml_file),
+    keyed by a hash of the input file contents, the featurization settings,
+    the tokenizer and the embeddings version."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_file_hash(path, block_size=1 << 20):
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                h.update(block)
+        return h.hexdigest()
+
+    def make_key(self, xml_file, **settings):
+        settings['file_hash'] = self.get_file_hash(xml_file)
+        content = json.dumps(settings, sort_keys=True)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def get_cache_file(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def load(self, key):
+        """returns a dict of the cached arrays or None"""
+        cache_file = self.get_cache_file(key)
+        if not os.path.isfile(cache_file):
+            self.misses += 1
+            return None
+        self.hits += 1
+        with np.load(cache_file) as npz:
+            return {name: npz[name] for name in npz.files}
+
+    def save(self, key, arrays):
+        # a unique name opened with 'x' (unlike mkstemp) gets the umask
+        # permissions, so a shared cache directory stays readable
+        tmp_file = os.path.join(self.cache_dir, '.{}.{}.npz.tmp'.format(
+            key, uuid.uuid4().hex))
+        try:
+            with open(tmp_file, 'xb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(tmp_file, self.get_cache_file(key))
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        hit_ratio = self.hits / float(total) if total > 0 else 0.0
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': hit_ratio}
@@ -1,34 +1,227 @@
+import os
 import sqlite3
-import functools
+import json
+import argparse
+import threading
 from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+import numpy as np
 
 
 class GloveHandler:
-    def __init__(self, db_file):
-        self.conn = sqlite3.connect(db_file, check_same_thread=False)
-        cursor = self.conn.cursor()
-        cursor.execute("PRAGMA synchronous = OFF")
-        cursor.execute("PRAGMA journal_mode = MEMORY")
-        self.conn.commit()
-        cursor.close()
+    """Read only access to a GloVe SQLite DB (glove_vecs table). Connections,
+    opened in read only mode with memory mapped I/O, are checked out of a
+    pool for each lookup and returned to it afterwards, so there are at most
+    as many connections as concurrent lookups. get_glove_vec results are
+    kept in a bounded per instance LRU cache."""
+
+    def __init__(self, db_file, cache_size=65536, mmap_size=1 << 30):
+        self.db_file = db_file
+        self.db_uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(db_file)))
+        self.mmap_size = mmap_size
+        self.dim = None
+        self.conns = []
+        self.idle_conns = []
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
 
+    @contextmanager
+    def get_conn(self):
+        with self.lock:
+            conn = self.idle_conns.pop() if self.idle_conns else None
+        if conn is None:
+            conn = sqlite3.connect(self.db_uri, uri=True, check_same_thread=False)
+            conn.execute("PRAGMA mmap_size = {}".format(int(self.mmap_size)))
+            with self.lock:
+                self.conns.append(conn)
+        try:
+            yield conn
+        finally:
+            with self.lock:
+                self.idle_conns.append(conn)
+
+    def get_version(self):
+        return get_file_version(self.db_file)
 
     def close(self):
-        if self.conn:
-            self.conn.close()
+        with self.lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns = []
+            self.idle_conns = []
 
-    @functools.lru_cache(maxsize=65536)
     def get_glove_vec(self, term):
+        with self.lock:
+            if term in self.cache:
+                self.cache.move_to_end(term)
+                self.hits += 1
+                return self.cache[term]
+            self.misses += 1
         sql = "select vector from glove_vecs where term = :term"
-        cursor = self.conn.cursor()
-        cursor.execute(sql, {"term": term})
-        vec_blob = cursor.fetchone()
-        cursor.close()
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, {"term": term})
+            vec_blob = cursor.fetchone()
+            cursor.close()
         if vec_blob:
             arr = array('f')
-            arr.fromstring(vec_blob[0])
+            arr.frombytes(vec_blob[0])
             glove_vec = arr.tolist()
         else:
-            return None
+            glove_vec = None
+        with self.lock:
+            self.cache[term] = glove_vec
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
         return glove_vec
 
+    def get_stats(self):
+        total = self.hits + self.misses
+        hit_ratio = self.hits / float(total) if total > 0 else 0.0
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': hit_ratio, 'cache_size': len(self.cache)}
+
+    def get_dim(self):
+        if self.dim is None:
+            with self.get_conn() as conn:
+                cursor = conn.cursor()
+                cursor.execute("select vector from glove_vecs limit 1")
+                vec_blob = cursor.fetchone()
+                cursor.close()
+            self.dim = len(vec_blob[0]) // 4 if vec_blob else 0
+        return self.dim
+
+    def get_glove_vecs(self, terms, chunk_size=500):
+        """returns a (len(terms), dim) float32 array of the vectors of the
+        terms and a boolean mask of the terms without a vector (zero rows).
+        Each distinct term is looked up once, in chunked IN queries."""
+        term2idx = {}
+        idxs = np.array([term2idx.setdefault(term, len(term2idx)) for term in terms],
+                        dtype=np.int64)
+        uniq_terms = list(term2idx.keys())
+        uniq_vecs = np.zeros((len(uniq_terms), self.get_dim()), dtype=np.float32)
+        uniq_oov = np.ones(len(uniq_terms), dtype=bool)
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            for i in range(0, len(uniq_terms), chunk_size):
+                chunk = uniq_terms[i:i+chunk_size]
+                sql = "select term, vector from glove_vecs where term in ({})".format(
+                    ",".join("?" * len(chunk)))
+                cursor.execute(sql, chunk)
+                for term, vec_blob in cursor.fetchall():
+                    idx = term2idx[term]
+                    uniq_vecs[idx] = np.frombuffer(vec_blob, dtype=np.float32)
+                    uniq_oov[idx] = False
+            cursor.close()
+        return uniq_vecs[idxs], uniq_oov[idxs]
+
+
+
+class MemmapGloveHandler:
+    """GloVe vectors served from a float32 .npy matrix (see
+    export_glove_vecs) memory mapped read only, so the vectors are
+    zero-copy rows shared through the page cache by all processes using the
+    same file."""
+
+    def __init__(self, npy_file, terms_file=None):
+        if terms_file is None:
+            terms_file = get_terms_file(npy_file)
+        self.npy_file = npy_file
+        self.vecs = np.load(npy_file, mmap_mode='r')
+        with open(terms_file) as f:
+            terms = json.load(f)
+        assert len(terms) == self.vecs.shape[0]
+        self.term2row = {term: i for i, term in enumerate(terms)}
+        self.dim = self.vecs.shape[1]
+
+    def get_version(self):
+        return get_file_version(self.npy_file)
+
+    def close(self):
+        self.vecs = None
+
+    def get_glove_vec(self, term):
+        row = self.term2row.get(term)
+        if row is None:
+            return None
+        return self.vecs[row]
+
+    def get_glove_vecs(self, terms):
+        """returns a (len(terms), dim) float32 array of the vectors of the
+        terms and a boolean mask of the terms without a vector (zero rows)"""
+        rows = np.array([self.term2row.get(term, -1) for term in terms],
+                        dtype=np.int64)
+        oov_mask = rows < 0
+        vecs = self.vecs[np.where(oov_mask, 0, rows)]
+        vecs[oov_mask] = 0
+        return vecs, oov_mask
+
+
+def get_file_version(path):
+    """identifies an embeddings file version by its name, size and
+    modification time"""
+    st = os.stat(path)
+    return "{}:{}:{}".format(os.path.basename(path), st.st_size, int(st.st_mtime))
+
+
+def get_terms_file(npy_file):
+    prefix = npy_file[:-4] if npy_file.endswith('.npy') else npy_file
+    return prefix + '.terms.json'
+
+
+def export_glove_vecs(db_file, npy_file, batch_size=100000):
+    """dumps the glove_vecs table of a GloVe SQLite DB to a float32 .npy
+    matrix (one row per term) and the row terms to a JSON list next to it"""
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+    cursor.execute("select count(*) from glove_vecs")
+    num_terms = cursor.fetchone()[0]
+    cursor.execute("select vector from glove_vecs limit 1")
+    dim = len(np.frombuffer(cursor.fetchone()[0], dtype=np.float32))
+    vecs = np.lib.format.open_memmap(npy_file, mode='w+', dtype=np.float32,
+                                     shape=(num_terms, dim))
+    terms = []
+    cursor.execute("select term, vector from glove_vecs")
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        offset = len(terms)
+        for i, (term, vec_blob) in enumerate(rows):
+            vecs[offset + i] = np.frombuffer(vec_blob, dtype=np.float32)
+            terms.append(term)
+        print("exported {} of {} vectors".format(len(terms), num_terms))
+    cursor.close()
+    conn.close()
+    vecs.flush()
+    del vecs
+    with open(get_terms_file(npy_file), 'w') as f:
+        json.dump(terms, f)
+
+
+def open_glove_handler(path):
+    """a MemmapGloveHandler for a .npy export, GloveHandler otherwise"""
+    if path.endswith('.npy'):
+        return MemmapGloveHandler(path)
+    return GloveHandler(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="exports a GloVe SQLite DB "
+                                                 "to a memory mappable .npy file")
+    parser.add_argument('-i', action='store', help="GloVe SQLite DB file", required=True)
+    parser.add_argument('-o', action='store', required=True,
+                        help="output .npy file (terms are written to <prefix>.terms.json)")
+    args = parser.parse_args()
+    export_glove_vecs(args.i, args.o)
+    print("wrote file:", args.o)
+
+
+if __name__ == '__main__':
+    main()
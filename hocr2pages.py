@@ -1,11 +1,19 @@
 import re
 import argparse
+import multiprocessing
+from collections import deque
+from bisect import bisect_left, bisect_right
 
-from xml.etree.ElementTree import Element, SubElement
+import numpy as np
+from xml.etree.ElementTree import SubElement
 import xml.etree.ElementTree as ET
-import spacy
 import utils
 
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
 
 class BBox(object):
     def __init__(self, y0, x0, y1, x1, node):
@@ -38,15 +46,15 @@ class Cluster(object):
 
     def add_member(self, member: BBox):
         self.members.append(member)
-        for m in self.members:
-            if self.y0min > m.y0:
-                self.y0min = m.y0
-            if self.x0min > m.x0:
-                self.x0min = m.x0
-            if self.x1max < m.x1:
-                self.x1max = m.x1
-            if self.y1max < m.y1:
-                self.y1max = m.y1
+        m = member
+        if self.y0min > m.y0:
+            self.y0min = m.y0
+        if self.x0min > m.x0:
+            self.x0min = m.x0
+        if self.x1max < m.x1:
+            self.x1max = m.x1
+        if self.y1max < m.y1:
+            self.y1max = m.y1
 
     def __str__(self):
         return '[%s %s %s %s]' % (self.y0min, self.x0min, self.y1max, self.x1max)
@@ -70,13 +78,13 @@ class Cluster(object):
     def area(self):
         return (self.y1max - self.y0min) * (self.x1max - self.x0min)
 
-    def grow2(self, clusters, ymin, ymax):
+    def grow2(self, clusters, ymin, ymax, index=None):
+        if index is None:
+            index = BBoxIndex(clusters)
         grown = False
-        for c in clusters:
-            for m in c.members:
-                if m.y1 < ymax and m.y0 > ymin:
-                    self.add_member(m)
-                    grown = True
+        for m in index.find_in_y_range(ymin, ymax):
+            self.add_member(m)
+            grown = True
         if grown:
             self.members.sort(key=lambda x: x.x0)
 
@@ -99,7 +107,7 @@ class Cluster(object):
         # return self.y0min <= y0 and self.y1max >= y1 and self.x0min <= x0 and self.x1max >= x1
         return self.y0min <= ymid and self.y1max >= ymid and self.x0min <= xmid and self.x1max >= xmid
 
-    def get_text(self, nlp=None):
+    def get_lines(self):
         lines = []
         for m in self.members:
             collect_text(m.node, lines)
@@ -112,16 +120,30 @@ class Cluster(object):
             if line[-1].endswith('-') and next_tok and str(next_tok[0]).islower():
                 line[-1] = line[-1][:-1] + lines[i + 1][0]
                 del lines[i + 1][0]
+        return lines
 
-        if nlp:
-            lines = clean_figure_text(lines, nlp, from_top=True)
-            lines = clean_figure_text(lines, nlp, from_top=False)
+    def get_text(self, nlp=None):
+        return get_clusters_text([self], nlp=nlp)[0]
 
-        content = ""
-        for line in lines:
-            content += " ".join(line) + "\n"
-        content = sanitize(content)
-        return content
+
+class BBoxIndex(object):
+    """Members of a list of clusters sorted by their vertical position for
+    range queries. Query results keep the cluster/member order the
+    boxes would be visited in by looping over the clusters."""
+
+    def __init__(self, clusters):
+        self.boxes = [m for c in clusters for m in c.members]
+        self.by_y0 = sorted(range(len(self.boxes)), key=lambda i: self.boxes[i].y0)
+        self.y0s = [self.boxes[i].y0 for i in self.by_y0]
+
+    def find_in_y_range(self, ymin, ymax):
+        """boxes with y0 > ymin and y1 < ymax"""
+        start = bisect_right(self.y0s, ymin)
+        # y1 >= y0, so no box starting at or below ymax qualifies
+        end = bisect_left(self.y0s, ymax)
+        found = [i for i in self.by_y0[start:end] if self.boxes[i].y1 < ymax]
+        found.sort()
+        return [self.boxes[i] for i in found]
 
 
 def sanitize(content):
@@ -132,33 +154,61 @@ def sanitize(content):
     return content
 
 
-def clean_figure_text(lines, nlp, from_top=True):
-    if len(lines) == 0:
-        return lines
-    removed = []
-    if from_top:
-        i = 0
-        while i < len(lines):
-            if utils.is_figure_text(lines[i], nlp):
-                removed.append(i)
-            else:
-                break
-            i += 1
+def lines_to_text(lines):
+    content = ""
+    for line in lines:
+        content += " ".join(line) + "\n"
+    return sanitize(content)
+
+
+def get_clusters_text(clusters, nlp=None):
+    """returns the text of each cluster with the figure text at the top and
+    bottom removed. The lines that may need tagging for this are tagged for
+    all the clusters in one batch. nlp can be a spaCy pipeline, a
+    utils.LineAnnotator or a utils.RuleCascade (to keep the rule stage counts
+    across pages)."""
+    cluster_lines = [c.get_lines() for c in clusters]
+    if nlp:
+        classifier = nlp
+        if not isinstance(classifier, utils.RuleCascade):
+            if not isinstance(nlp, utils.LineAnnotator):
+                nlp = utils.LineAnnotator(nlp)
+            classifier = utils.RuleCascade(nlp)
+        if isinstance(classifier.nlp, utils.LineAnnotator):
+            candidates = []
+            for lines in cluster_lines:
+                candidates.extend(figure_text_candidates(lines))
+            classifier.nlp.annotate(candidates)
+        for i, lines in enumerate(cluster_lines):
+            lines = clean_figure_text(lines, classifier, from_top=True)
+            cluster_lines[i] = clean_figure_text(lines, classifier, from_top=False)
+    return [lines_to_text(lines) for lines in cluster_lines]
+
+
+def figure_text_candidates(lines):
+    """the lines clean_figure_text() may need to tag: the short lines before
+    the first and after the last long line"""
+    long_lines = [i for i, line in enumerate(lines)
+                  if utils.figure_text_rules(line)[0] == 'long']
+    if long_lines:
+        edge_lines = lines[:long_lines[0]] + lines[long_lines[-1] + 1:]
     else:
-        i = len(lines) - 1
-        while i >= 0:
-            if utils.is_figure_text(lines[i], nlp):
-                removed.append(i)
-            else:
-                break
-            i -= 1
-    if len(removed) == 0:
-        return lines
-    filtered = []
-    for i, line in enumerate(lines):
-        if i not in removed:
-            filtered.append(line)
-    return filtered
+        edge_lines = lines
+    return [" ".join(line) for line in edge_lines
+            if utils.figure_text_rules(line)[1] is None]
+
+
+def clean_figure_text(lines, classifier, from_top=True):
+    num_lines = len(lines)
+    num_removed = 0
+    while num_removed < num_lines:
+        i = num_removed if from_top else num_lines - 1 - num_removed
+        if not classifier.is_figure_text(lines[i]):
+            break
+        num_removed += 1
+    if from_top:
+        return lines[num_removed:]
+    return lines[:num_lines - num_removed]
 
 
 def remove_figure_captions(content):
@@ -227,17 +277,20 @@ def collect_text(node, lines):
 
 def cluster_bboxes(bbox_list, top_el=None, nlp=None):
     clusters = []
+    # cluster creation order by the y0 of its first member (see Cluster.belongs)
+    y0_index = {}
     for bbox in bbox_list:
         closest = None
-        for c in clusters:
-            if c.belongs(bbox):
-                closest = c
-                break
-        if closest:
-            closest.add_member(bbox)
+        for y0 in (bbox.y0 - 1, bbox.y0, bbox.y0 + 1):
+            idx = y0_index.get(y0)
+            if idx is not None and (closest is None or idx < closest):
+                closest = idx
+        if closest is not None:
+            clusters[closest].add_member(bbox)
         else:
             c = Cluster(bbox.y0)
             c.add_member(bbox)
+            y0_index[bbox.y0] = len(clusters)
             clusters.append(c)
     for c in clusters:
         print("Cluster {} - members:{} {}".format(c.label, len(c.members), c))
@@ -249,23 +302,18 @@ def cluster_bboxes(bbox_list, top_el=None, nlp=None):
         clist = list(clusters)
         clist.remove(ct[0])
         clist.remove(ct[1])
-        ct[0].grow2(clist, 0, ymid)
-        ct[1].grow2(clist, ymid, ymax)
+        index = BBoxIndex(clist)
+        ct[0].grow2(clist, 0, ymid, index=index)
+        ct[1].grow2(clist, ymid, ymax, index=index)
         print("Left Column Cluster {} - members:{} {}".format(ct[0].label, len(ct[0].members), ct[0]))
         print("Right  Column Cluster {} - members:{} {}".format(ct[1].label, len(ct[1].members), ct[1]))
 
-        content = ""
+        left_text, right_text = get_clusters_text(ct, nlp=nlp)
+        content = left_text + right_text
         print("Left Column\n---------\n")
-        col_text = ct[0].get_text(nlp=nlp)
-        content += col_text
-        print(col_text)
+        print(left_text)
         print("\nRight Column\n---------\n")
-        col_text = ct[1].get_text(nlp=nlp)
-        content += col_text
-        print(col_text)
-        if top_el is not None:
-            page_el = SubElement(top_el, 'page')
-            page_el.text = content
+        print(right_text)
     else:
         # assumption: a single column
         clusters = []
@@ -274,14 +322,13 @@ def cluster_bboxes(bbox_list, top_el=None, nlp=None):
             c.add_member(bbox)
             clusters.append(c)
 
-        content = ''
-        for c in clusters:
-            content += c.get_text(nlp=nlp)
+        content = ''.join(get_clusters_text(clusters, nlp=nlp))
         print(content)
-        if top_el is not None:
-            page_el = SubElement(top_el, 'page')
-            page_el.text = content
+    if top_el is not None:
+        page_el = SubElement(top_el, 'page')
+        page_el.text = content
     print('-' * 80)
+    return content
 
 
 def find_columns(clusters):
@@ -297,7 +344,91 @@ def find_columns(clusters):
     return (col1, col2) if col1.get_y0() < col2.get_y0() else (col2, col1)
 
 
-def handle_page(node, num_cols=2, top_el=None, nlp=None):
+def bboxes_to_array(bbox_list):
+    """(N, 4) int array of y0, x0, y1, x1 (in BBox terms) per box"""
+    if not bbox_list:
+        return np.zeros((0, 4), dtype=np.int64)
+    return np.array([(b.y0, b.x0, b.y1, b.x1) for b in bbox_list], dtype=np.int64)
+
+
+def find_column_bounds(boxes, max_cols=3, min_gap_ratio=0.02, wide_ratio=0.6):
+    """finds up to max_cols columns from the projection of the boxes onto the
+    y0/y1 axis (the axis cluster_bboxes and find_columns split columns on).
+    Boxes wider than wide_ratio of the page span (titles, full width figures)
+    are left out of the projection. Returns the sorted column boundaries
+    (midpoints of the widest empty gaps), empty for a single column."""
+    if len(boxes) < 2:
+        return np.zeros(0)
+    lo, hi = boxes[:, 0].min(), boxes[:, 2].max()
+    span = hi - lo
+    if span <= 0:
+        return np.zeros(0)
+    narrow = boxes[(boxes[:, 2] - boxes[:, 0]) <= wide_ratio * span]
+    if len(narrow) < 2:
+        return np.zeros(0)
+    # coverage histogram via a difference array over [lo, hi]
+    diff = np.zeros(span + 2, dtype=np.int64)
+    np.add.at(diff, narrow[:, 0] - lo, 1)
+    np.add.at(diff, narrow[:, 2] - lo + 1, -1)
+    empty = np.cumsum(diff[:-1]) == 0
+    # runs of empty bins
+    edges = np.diff(np.concatenate(([0], empty.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    widths = ends - starts
+    # gaps touching the page span are margins, not column gutters
+    inner = (starts > 0) & (ends < len(empty)) & (widths >= max(1, min_gap_ratio * span))
+    starts, ends, widths = starts[inner], ends[inner], widths[inner]
+    if len(widths) == 0:
+        return np.zeros(0)
+    widest = np.argsort(-widths, kind='stable')[:max_cols - 1]
+    return np.sort(lo + (starts[widest] + ends[widest]) / 2.0)
+
+
+def layout_columns(bbox_list, max_cols=3):
+    """groups the boxes of a page in reading order into column clusters.
+    Boxes crossing a column boundary break the page into bands; within a band
+    the columns are read one after another, each from top to bottom."""
+    boxes = bboxes_to_array(bbox_list)
+    bounds = find_column_bounds(boxes, max_cols=max_cols)
+    print('# columns:', len(bounds) + 1)
+    if len(boxes) == 0:
+        return []
+    ymid = (boxes[:, 0] + boxes[:, 2]) / 2.0
+    col = np.searchsorted(bounds, ymid)
+    spanning = ((boxes[:, 0:1] < bounds) & (boxes[:, 2:3] > bounds)).any(axis=1)
+    span_tops = np.sort(boxes[spanning, 1])
+    # even bands for column text, odd bands for the boxes crossing columns
+    band = 2 * np.searchsorted(span_tops, boxes[:, 1], side='right')
+    band[spanning] = 2 * np.argsort(np.argsort(boxes[spanning, 1], kind='stable'),
+                                    kind='stable') + 1
+    col[spanning] = 0
+    order = np.lexsort((boxes[:, 1], col, band))
+    clusters = []
+    prev = None
+    for i in order:
+        key = (band[i], col[i])
+        if key != prev:
+            clusters.append(Cluster(bbox_list[i].y0))
+            prev = key
+        clusters[-1].add_member(bbox_list[i])
+    return clusters
+
+
+def column_layout_text(bbox_list, top_el=None, nlp=None, max_cols=3):
+    clusters = layout_columns(bbox_list, max_cols=max_cols)
+    for c in clusters:
+        print("Column Cluster {} - members:{} {}".format(c.label, len(c.members), c))
+    content = ''.join(get_clusters_text(clusters, nlp=nlp))
+    print(content)
+    if top_el is not None:
+        page_el = SubElement(top_el, 'page')
+        page_el.text = content
+    print('-' * 80)
+    return content
+
+
+def handle_page(node, num_cols=2, top_el=None, nlp=None, layout='clusters'):
     bbox_list = []
     for child in node:
         if child.tag != 'div':
@@ -305,33 +436,134 @@ def handle_page(node, num_cols=2, top_el=None, nlp=None):
         bbox = BBox.from_node(child)
         bbox_list.append(bbox)
     print('# boxes:', len(bbox_list))
-    cluster_bboxes(bbox_list, top_el=top_el, nlp=nlp)
+    if layout == 'columns':
+        return column_layout_text(bbox_list, top_el=top_el, nlp=nlp)
+    return cluster_bboxes(bbox_list, top_el=top_el, nlp=nlp)
+
+
+def iter_pages(hocr_file, use_lxml=True):
+    """yields the page divs (body/div) of a HOCR file one at a time. Each page
+    is cleared and detached after it is consumed so memory does not grow with
+    the number of pages. Uses the lxml HTML parser (with error recovery) when
+    it is installed."""
+    if use_lxml and lxml_etree is not None:
+        yield from _iter_pages_lxml(hocr_file)
+    else:
+        yield from _iter_pages_etree(hocr_file)
+
+
+def _iter_pages_etree(hocr_file):
+    body = None
+    parents = []
+    for event, elem in ET.iterparse(hocr_file, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'body' and body is None:
+                body = elem
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag == 'div' and parents and parents[-1] is body:
+            yield elem
+            elem.clear()
+            body.remove(elem)
+
+
+def _iter_pages_lxml(hocr_file):
+    for _, elem in lxml_etree.iterparse(hocr_file, events=('end',), tag='div',
+                                        html=True, recover=True,
+                                        encoding='utf-8'):
+        parent = elem.getparent()
+        if parent is None or parent.tag != 'body':
+            continue
+        yield elem
+        elem.clear()
+        # drop the already handled pages (and anything else) before this one
+        while elem.getprevious() is not None:
+            del parent[0]
+        parent.remove(elem)
+
+
+def page_to_bytes(node):
+    if lxml_etree is not None and isinstance(node, lxml_etree._Element):
+        return lxml_etree.tostring(node, encoding='utf-8')
+    return ET.tostring(node, encoding='utf-8')
+
+
+# per worker process state for the parallel mode (see init_worker)
+_worker_nlp = None
+_worker_layout = 'clusters'
+
+
+def init_worker(model_name, layout='clusters'):
+    global _worker_nlp, _worker_layout
+    _worker_nlp = utils.load_nlp(model_name)
+    _worker_layout = layout
+
+
+def handle_page_bytes(page_bytes):
+    node = ET.fromstring(page_bytes)
+    return handle_page(node, nlp=_worker_nlp, layout=_worker_layout)
+
+
+def convert_parallel(hocr_file, out_xml_file, model_name, num_jobs,
+                     use_lxml=True, window=None, layout='clusters'):
+    """converts the pages with a pool of num_jobs worker processes, each
+    loading the spaCy model once. At most window pages are in flight and the
+    pages are written in their original order."""
+    if window is None:
+        window = 4 * num_jobs
+    pending = deque()
+    with multiprocessing.Pool(num_jobs, initializer=init_worker,
+                              initargs=(model_name, layout)) as pool:
+        with utils.XMLStreamWriter(out_xml_file, 'pdf') as writer:
+            for node in iter_pages(hocr_file, use_lxml=use_lxml):
+                if len(pending) >= window:
+                    writer.write_text('page', pending.popleft().get())
+                pending.append(pool.apply_async(handle_page_bytes,
+                                                (page_to_bytes(node),)))
+            while pending:
+                writer.write_text('page', pending.popleft().get())
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', action='store', help="input HOCR html file", required=True)
     parser.add_argument('-o', action='store', help="output text XML file", required=True)
+    parser.add_argument('--model', action='store', default='en_core_web_sm',
+                        help="spaCy model name (default: en_core_web_sm)")
+    parser.add_argument('--no-lxml', action='store_true',
+                        help="use the standard library XML parser even if lxml is installed")
+    parser.add_argument('-j', action='store', type=int, default=1,
+                        help="number of worker processes (default: 1)")
+    parser.add_argument('--layout', action='store', choices=['clusters', 'columns'],
+                        default='clusters',
+                        help="page layout analysis: 'clusters' (two column clustering) or "
+                             "'columns' (1-3 columns from box projection) (default: clusters)")
 
     args = parser.parse_args()
 
     hocr_file = args.i
     out_xml_file = args.o
-    nlp = spacy.load("en_core_web_sm")
+    if args.j > 1:
+        convert_parallel(hocr_file, out_xml_file, args.model, args.j,
+                         use_lxml=not args.no_lxml, layout=args.layout)
+        print("wrote file:", out_xml_file)
+        return
+    nlp = utils.load_nlp(args.model)
     print("loaded spacy.")
-    tree = ET.parse(hocr_file)
-    top = Element('pdf')
-    for node in tree.findall('.//body/div'):
-        handle_page(node, top_el=top, nlp=nlp)
-    utils.indent(top)
-    out_tree = ET.ElementTree(top)
-    out_tree.write(out_xml_file, encoding="UTF-8")
+    classifier = utils.RuleCascade(utils.LineAnnotator(nlp))
+    with utils.XMLStreamWriter(out_xml_file, 'pdf') as writer:
+        for node in iter_pages(hocr_file, use_lxml=not args.no_lxml):
+            writer.write_text('page', handle_page(node, nlp=classifier,
+                                                  layout=args.layout))
+            # the stage counts are kept for the book, the tagged lines are not
+            classifier.nlp.clear()
+    classifier.print_report()
     print("wrote file:", out_xml_file)
 
 
 def test_driver():
-    tree = ET.parse('x.html')
-    for node in tree.findall('.//body/div'):
+    for node in iter_pages('x.html'):
         print(node.attrib)
         handle_page(node)
 
@@ -0,0 +1,62 @@
+import json
+import argparse
+import urllib.request
+import xml.etree.ElementTree as ET
+
+import utils
+
+
+def clean_pages(texts, url='http://127.0.0.1:8765', threshold=None,
+                timeout=600):
+    """sends page texts to a junk_server.py server, returns the cleaned texts"""
+    request = {'pages': texts}
+    if threshold is not None:
+        request['threshold'] = threshold
+    req = urllib.request.Request(url.rstrip('/') + '/clean',
+                                 data=json.dumps(request).encode('utf-8'),
+                                 headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read().decode('utf-8'))['pages']
+
+
+def iter_page_texts(xml_file):
+    for _, elem in ET.iterparse(xml_file):
+        if elem.tag == 'page':
+            yield elem.text or ''
+            elem.clear()
+
+
+def clean_file(xml_file, out_xml_file, url='http://127.0.0.1:8765',
+               threshold=None, pages_per_request=50):
+    with utils.XMLStreamWriter(out_xml_file, 'pdf') as writer:
+        chunk = []
+        for text in iter_page_texts(xml_file):
+            chunk.append(text)
+            if len(chunk) == pages_per_request:
+                for content in clean_pages(chunk, url=url, threshold=threshold):
+                    writer.write_text('page', content)
+                chunk = []
+        if chunk:
+            for content in clean_pages(chunk, url=url, threshold=threshold):
+                writer.write_text('page', content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cleans a hocr2pages.py XML file "
+                                                 "with a running junk_server.py")
+    parser.add_argument('-i', action='store', help="input XML file", required=True)
+    parser.add_argument('-o', action='store', help="cleaned XML file", required=True)
+    parser.add_argument('--url', action='store', default='http://127.0.0.1:8765',
+                        help="server URL (default: http://127.0.0.1:8765)")
+    parser.add_argument('--threshold', action='store', type=float, default=None,
+                        help="keep lines scoring above this (default: server's 0.5)")
+    parser.add_argument('--pages-per-request', action='store', type=int, default=50,
+                        help="number of pages sent per request (default: 50)")
+    args = parser.parse_args()
+    clean_file(args.i, args.o, url=args.url, threshold=args.threshold,
+               pages_per_request=args.pages_per_request)
+    print("wrote file:", args.o)
+
+
+if __name__ == '__main__':
+    main()
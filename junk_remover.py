@@ -1,22 +1,21 @@
 import argparse
 import pickle
+import json
 import spacy
-import keras
-from keras.models import Sequential
-from keras.layers import Dense, Flatten, Concatenate, GlobalMaxPooling1D, GlobalAveragePooling1D
-from keras.layers import LSTM, Bidirectional
+# keras (TensorFlow) is imported where needed so that cleaning with the
+# NumPy model (numpy_model.py) does not load it
 # from keras.models import Model
 from sklearn.metrics import precision_recall_curve
 
-from keras_self_attention import SeqSelfAttention
-
 
 import numpy as np
-from xml.etree.ElementTree import Element, SubElement
 import xml.etree.ElementTree as ET
+import os
 from os.path import expanduser
 
-from glove_handler import GloveHandler
+from glove_handler import GloveHandler, open_glove_handler
+from feature_cache import FeatureCache
+from numpy_model import NumpyModel, EmbeddingLayer
 import utils
 
 
@@ -26,21 +25,35 @@ class Section(object):
         self.lines = lines
         self.prev_line = prev_line
         self.next_line = next_line
+        self.line_tokens = None
 
     def size(self):
         return len(self.lines)
 
-    def get_context_window(self, line_idx, nlp):
+    def tokenize(self, tokenizer):
+        """tokenizes each distinct line of the section (and its neighbour
+        lines) once"""
+        texts = list(dict.fromkeys(self.lines))
+        for line in (self.prev_line, self.next_line):
+            if line and line not in texts:
+                texts.append(line)
+        self.line_tokens = {}
+        for line, doc in zip(texts, tokenizer.pipe(texts)):
+            self.line_tokens[line] = [token.text for token in doc]
+
+    def get_window_lines(self, line_idx):
+        """returns the lines of the context window of a line and whether the
+        window starts and ends within the text"""
         assert line_idx >= 0 and line_idx < self.size()
-        tokens = []
         window = []
+        has_first = True
         has_last = True
         i = line_idx
         if i == 0:
             if self.prev_line:
                 window.append(self.prev_line)
             else:
-                tokens.append('\n')
+                has_first = False
             window.append(self.lines[i])
             if i+1 == self.size():
                 if self.next_line:
@@ -54,7 +67,7 @@ class Section(object):
                 if self.prev_line:
                     window.append(self.lines[i-1])
                 else:
-                    tokens.append('\n')
+                    has_first = False
             else:
                 window.append(self.lines[i-1])
             window.append(self.lines[i])
@@ -66,10 +79,15 @@ class Section(object):
             window.append(self.lines[i-1])
             window.append(self.lines[i])
             window.append(self.lines[i+1])
+        return window, has_first, has_last
 
-        for doc in nlp.pipe(window, disable=['ner', 'parser']):
-            for token in doc:
-                tokens.append(token.text)
+    def get_context_window(self, line_idx, nlp):
+        if self.line_tokens is None:
+            self.tokenize(nlp.tokenizer)
+        window, has_first, has_last = self.get_window_lines(line_idx)
+        tokens = [] if has_first else ['\n']
+        for line in window:
+            tokens.extend(self.line_tokens[line])
         if not has_last:
             tokens.append('\n')
         return tokens
@@ -111,7 +129,11 @@ def has_bad_sections(sections):
 
 
 def handle_page(node, sections):
-    lines = node.text.split("\n")
+    handle_page_text(node.text, sections)
+
+
+def handle_page_text(text, sections):
+    lines = text.split("\n")
     print(len(lines))
     num_lines = len(lines)
     offset = 0
@@ -165,27 +187,337 @@ def prepare_section_tr_data(training_sections, nlp, max_length):
     return data, np.array(labels)
 
 
+class PreparedInstances(object):
+    """The instances (context window token lists) of the pages of an
+    annotated XML file with their labels, as token ids into the file's
+    terms, and the GloVe vectors of these terms (unk1 for the terms
+    without one), so the features can be rebuilt without tokenization or
+    GloVe lookups (see FeatureCache)."""
+
+    def __init__(self, terms, token_ids, lengths, labels, page_offsets,
+                 term_vecs):
+        self.terms = terms
+        self.token_ids = token_ids
+        self.lengths = lengths
+        self.labels = labels
+        self.page_offsets = page_offsets
+        self.term_vecs = term_vecs
+
+    @classmethod
+    def from_pages(cls, page_data, page_labels, glove_handler, max_length,
+                   gv_dim=100):
+        # id 0 is the padding
+        term2id = {}
+        page_offsets = [0]
+        for data in page_data:
+            for tokens in data:
+                for token in tokens:
+                    term2id.setdefault(token, len(term2id) + 1)
+            page_offsets.append(page_offsets[-1] + len(data))
+        data = [tokens for data in page_data for tokens in data]
+        token_ids = np.zeros((len(data), max_length), dtype='int32')
+        lengths = np.zeros(len(data), dtype='int32')
+        for i, tokens in enumerate(data):
+            ids = [term2id[token] for token in tokens[:max_length]]
+            token_ids[i, :len(ids)] = ids
+            lengths[i] = len(ids)
+        terms = list(term2id.keys())
+        term_vecs = np.zeros((len(terms) + 1, gv_dim), dtype='float32')
+        if terms:
+            term_vecs[1:] = get_term_vecs(terms, glove_handler)
+        labels = np.concatenate([np.asarray(labels, dtype='int64') for labels in page_labels]) \
+            if page_labels else np.zeros(0, dtype='int64')
+        return cls(terms, token_ids, lengths, labels,
+                   np.array(page_offsets, dtype='int64'), term_vecs)
+
+    def to_arrays(self):
+        return {'terms': np.array(json.dumps(self.terms)),
+                'token_ids': self.token_ids, 'lengths': self.lengths,
+                'labels': self.labels, 'page_offsets': self.page_offsets,
+                'term_vecs': self.term_vecs}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(json.loads(str(arrays['terms'])), arrays['token_ids'],
+                   arrays['lengths'], arrays['labels'], arrays['page_offsets'],
+                   arrays['term_vecs'])
+
+    def num_pages(self):
+        return len(self.page_offsets) - 1
+
+    def get_range(self, page_idx=None, end_page_idx=None):
+        """the instance range of a page (or of the pages up to
+        end_page_idx), all instances if page_idx is None"""
+        if page_idx is None:
+            return 0, len(self.labels)
+        if end_page_idx is None:
+            end_page_idx = page_idx + 1
+        return self.page_offsets[page_idx], self.page_offsets[end_page_idx]
+
+    def get_data(self, page_idx=None):
+        return self.slice_data(*self.get_range(page_idx))
+
+    def get_labels(self, page_idx=None):
+        start, end = self.get_range(page_idx)
+        return self.labels[start:end]
+
+    def get_features(self, page_idx=None):
+        """the (n, max_length, gv_dim) input as built by prep_data"""
+        return self.slice_features(*self.get_range(page_idx))
+
+    def slice_data(self, start, end):
+        return [[self.terms[t - 1] for t in self.token_ids[i, :self.lengths[i]]]
+                for i in range(start, end)]
+
+    def slice_features(self, start, end):
+        return self.term_vecs[self.token_ids[start:end]]
+
+
+def prepare_xml_file(xml_file, nlp, glove_handler, max_length, gv_dim=100,
+                     training=False, cache=None):
+    """the PreparedInstances of the pages of an annotated XML file (only
+    of the pages with junk as one page if training), reused from the
+    FeatureCache if given"""
+    key = None
+    if cache is not None:
+        key = cache.make_key(xml_file, training=training, max_length=max_length,
+                             gv_dim=gv_dim,
+                             tokenizer=utils.get_model_id(nlp),
+                             embeddings=glove_handler.get_version())
+        arrays = cache.load(key)
+        if arrays is not None:
+            print("using cached instances for", xml_file)
+            return PreparedInstances.from_arrays(arrays)
+    if training:
+        page_sections = {0: extract_sections(xml_file)}
+    else:
+        page_sections = extract_page_sections(xml_file)
+    page_data, page_labels = [], []
+    for page_idx, sections in page_sections.items():
+        data, labels = prepare_section_tr_data(sections, nlp, max_length)
+        page_data.append(data)
+        page_labels.append(labels)
+    prepared = PreparedInstances.from_pages(page_data, page_labels,
+                                            glove_handler, max_length,
+                                            gv_dim=gv_dim)
+    if cache is not None:
+        cache.save(key, prepared.to_arrays())
+    return prepared
+
+
+def get_term_vecs(terms, glove_handler):
+    """the GloVe vectors of the terms with the unk1 vector for the terms
+    without one"""
+    vecs, oov_mask = glove_handler.get_glove_vecs(terms)
+    if oov_mask.any():
+        #if utils.get_ascii_ratio(token) <= 0.5:
+        #    vec = glove_handler.get_glove_vec('unk2')
+        #elif utils.is_mostly_numbers(token):
+        #    vec = glove_handler.get_glove_vec('unk3')
+        #else:
+        unk_vec = glove_handler.get_glove_vec('unk1')
+        if unk_vec is not None:
+            vecs[oov_mask] = unk_vec
+    return vecs
+
+
 def prep_data(data, max_length, glove_handler, gv_dim=100):
-    Xs = np.zeros((len(data), max_length * gv_dim), dtype='float32')
+    Xs = np.zeros((len(data), max_length, gv_dim), dtype='float32')
+    # (instance, position) of every token, looked up in one batch
+    rows, cols, terms = [], [], []
     for i, tokens in enumerate(data):
-        for j, token in enumerate(tokens):
-            offset = j * gv_dim
-            vec = glove_handler.get_glove_vec(token)
-            if vec:
-                Xs[i, offset:offset+gv_dim] = vec
-            else:
-                #if utils.get_ascii_ratio(token) <= 0.5:
-                #    vec = glove_handler.get_glove_vec('unk2')
-                #elif utils.is_mostly_numbers(token):
-                #    vec = glove_handler.get_glove_vec('unk3')
-                #else:
-                vec = glove_handler.get_glove_vec('unk1')
-                Xs[i, offset:offset+gv_dim] = vec
+        for j, token in enumerate(tokens[:max_length]):
+            rows.append(i)
+            cols.append(j)
+            terms.append(token)
+    if terms:
+        Xs[rows, cols] = get_term_vecs(terms, glove_handler)
+    return Xs.reshape(len(data), max_length * gv_dim)
+
+
+def build_vocab(data, glove_handler, gv_dim=100):
+    """returns the vocabulary (term to id) of the tokens with a GloVe vector
+    and the matching embedding matrix. Id 0 is the padding (zero vector) and
+    id 1 the unknown term (unk1 vector)"""
+    terms = list(dict.fromkeys(token for tokens in data for token in tokens))
+    vocab = {'<pad>': 0, 'unk1': 1}
+    embedding_rows = [np.zeros(gv_dim, dtype='float32')]
+    unk_vec = glove_handler.get_glove_vec('unk1')
+    embedding_rows.append(np.zeros(gv_dim, dtype='float32') if unk_vec is None
+                          else np.asarray(unk_vec, dtype='float32'))
+    if terms:
+        vecs, oov_mask = glove_handler.get_glove_vecs(terms)
+        for term, vec, oov in zip(terms, vecs, oov_mask):
+            if oov or term in vocab:
+                continue
+            vocab[term] = len(embedding_rows)
+            embedding_rows.append(vec)
+    return vocab, np.vstack(embedding_rows)
+
+
+def prep_token_ids(data, max_length, vocab):
+    """(N, max_length) int32 token id matrix, the token id counterpart of
+    prep_data"""
+    Xs = np.zeros((len(data), max_length), dtype='int32')
+    for i, tokens in enumerate(data):
+        ids = [vocab.get(token, 1) for token in tokens[:max_length]]
+        Xs[i, :len(ids)] = ids
     return Xs
 
 
-def build_attention_model(gv_dim=100, max_length=100):
+def get_vocab_file(model_file):
+    return model_file + '.vocab.json'
+
+
+def save_vocab(vocab, vocab_file):
+    with open(vocab_file, 'w') as f:
+        json.dump(vocab, f)
+
+
+def load_vocab(vocab_file):
+    with open(vocab_file) as f:
+        return json.load(f)
+
+
+def featurize(data, max_length, glove_handler, gv_dim=100, vocab=None):
+    """model input for the instances, token ids if a vocabulary is given,
+    GloVe vector sequences otherwise"""
+    if vocab is not None:
+        return prep_token_ids(data, max_length, vocab)
+    Xs = prep_data(data, max_length, glove_handler, gv_dim=gv_dim)
+    return Xs.reshape(len(data), max_length, gv_dim)
+
+
+class FeatureBatches(object):
+    """Batches of model input (and labels, if given) featurized on the fly
+    from the token lists of the instances, so memory is bounded by the batch
+    size (see make_feature_sequence)."""
+
+    def __init__(self, data, labels, max_length, glove_handler, gv_dim=100,
+                 vocab=None, batch_size=32, shuffle=False):
+        self.data = data
+        self.labels = labels
+        self.max_length = max_length
+        self.glove_handler = glove_handler
+        self.gv_dim = gv_dim
+        self.vocab = vocab
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.indices = np.arange(len(data))
+        if shuffle:
+            np.random.shuffle(self.indices)
+        # extra model.fit/predict arguments for the batches
+        self.keras_kwargs = {}
+
+    def __len__(self):
+        return (len(self.data) + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, idx):
+        batch = self.indices[idx * self.batch_size:(idx + 1) * self.batch_size]
+        X = featurize([self.data[i] for i in batch], self.max_length,
+                      self.glove_handler, gv_dim=self.gv_dim, vocab=self.vocab)
+        if self.labels is None:
+            return X
+        return X, self.labels[batch]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.indices)
+
+
+_feature_sequence_class = None
+
+
+def make_feature_sequence(data, labels, max_length, glove_handler, gv_dim=100,
+                          vocab=None, batch_size=32, shuffle=False, workers=4,
+                          max_queue_size=10):
+    """FeatureBatches as a keras.utils.Sequence. With workers > 1 the next
+    batches are prepared by background threads (GloveHandler is thread safe)
+    while the model runs."""
+    global _feature_sequence_class
+    if _feature_sequence_class is None:
+        import keras
+
+        class FeatureSequence(FeatureBatches, keras.utils.Sequence):
+            def __init__(self, *args, workers=4, max_queue_size=10, **kwargs):
+                try:
+                    keras.utils.Sequence.__init__(self, workers=workers,
+                                                  use_multiprocessing=False,
+                                                  max_queue_size=max_queue_size)
+                    prefetch_kwargs = {}
+                except TypeError:
+                    # Keras 2 Sequence, prefetching is set up in fit/predict
+                    keras.utils.Sequence.__init__(self)
+                    prefetch_kwargs = {'workers': workers, 'use_multiprocessing': False,
+                                       'max_queue_size': max_queue_size}
+                FeatureBatches.__init__(self, *args, **kwargs)
+                self.keras_kwargs = prefetch_kwargs
+
+        _feature_sequence_class = FeatureSequence
+    return _feature_sequence_class(data, labels, max_length, glove_handler,
+                                   gv_dim=gv_dim, vocab=vocab,
+                                   batch_size=batch_size, shuffle=shuffle,
+                                   workers=workers,
+                                   max_queue_size=max_queue_size)
+
+
+def print_cache_stats(cache):
+    stats = cache.get_stats()
+    print('feature cache hits:{} misses:{} hit ratio:{:.2f}'.format(
+        stats['hits'], stats['misses'], stats['hit_ratio']))
+
+
+def load_model(model_file, use_numpy=False, custom_objects=None):
+    """the saved classifier, as a NumpyModel (no TensorFlow needed) if
+    use_numpy is set. A token id model is returned without its Embedding
+    layer (see drop_embedding_layer), so all models take the GloVe vector
+    input of featurize() without a vocabulary."""
+    if use_numpy:
+        return drop_embedding_layer(NumpyModel.load(model_file))
+    import keras
+    return drop_embedding_layer(keras.models.load_model(model_file,
+                                                        custom_objects=custom_objects))
+
+
+def drop_embedding_layer(model):
+    """the model without its leading Embedding layer. The layer is frozen and
+    its rows are the GloVe vectors (unk1 for id 1) of the training
+    vocabulary, so the GloVe vector sequences give the same layer output for
+    the training terms, and the real vectors instead of unk1 for the terms
+    with a GloVe vector seen only at prediction time."""
+    if isinstance(model, NumpyModel):
+        if not model.layers or not isinstance(model.layers[0], EmbeddingLayer):
+            return model
+        embeddings = model.layers[0].embeddings
+        return NumpyModel(model.layers[1:],
+                          input_shape=model.input_shape + embeddings.shape[1:])
+    import keras
+    embedding = model.layers[0]
+    if not isinstance(embedding, keras.layers.Embedding):
+        return model
+    max_length = model.input_shape[1]
+    return keras.Sequential([keras.Input(shape=(max_length, embedding.output_dim))] +
+                            model.layers[1:])
+
+
+def add_embedding_layer(model, embedding_matrix, max_length):
+    from keras.layers import Embedding
+    model.add(Embedding(embedding_matrix.shape[0], embedding_matrix.shape[1],
+                        trainable=False, input_shape=(max_length,)))
+
+
+def set_embedding_weights(model, embedding_matrix):
+    # set after building so the matrix is not part of the layer config
+    if embedding_matrix is not None:
+        model.layers[0].set_weights([embedding_matrix])
+
+
+def build_attention_model(gv_dim=100, max_length=100, embedding_matrix=None):
+    from keras.models import Sequential
+    from keras.layers import Dense, Flatten, LSTM
     model = Sequential()
+    if embedding_matrix is not None:
+        add_embedding_layer(model, embedding_matrix, max_length)
     model.add(LSTM(20, dropout=0.1,
                    recurrent_dropout=0.1,
                    return_sequences=True,
@@ -194,14 +526,19 @@ def build_attention_model(gv_dim=100, max_length=100):
     # model.add(GlobalAveragePooling1D())
     model.add(Flatten())
     model.add(Dense(1, activation='sigmoid'))
+    set_embedding_weights(model, embedding_matrix)
     model.summary()
     model.compile(loss="binary_crossentropy", optimizer="rmsprop",
                   metrics=['acc'])
     return model
 
 
-def build_LSTM_model(gv_dim=100, max_length=100):
+def build_LSTM_model(gv_dim=100, max_length=100, embedding_matrix=None):
+    from keras.models import Sequential
+    from keras.layers import Dense, Flatten, LSTM, Bidirectional
     model = Sequential()
+    if embedding_matrix is not None:
+        add_embedding_layer(model, embedding_matrix, max_length)
     model.add(Bidirectional(LSTM(20, dropout=0.1,
                                  recurrent_dropout=0.1,
                                  return_sequences=False),
@@ -212,6 +549,7 @@ def build_LSTM_model(gv_dim=100, max_length=100):
     #               input_shape=(max_length, gv_dim)))
     model.add(Flatten())
     model.add(Dense(1, activation='sigmoid'))
+    set_embedding_weights(model, embedding_matrix)
     model.summary()
     model.compile(loss="binary_crossentropy", optimizer="rmsprop",
                   metrics=['acc'])
@@ -228,11 +566,18 @@ def train_model(train_X, train_labels, max_length=100, gv_dim=100):
 
 
 def train_model_full(train_X, train_labels, model_file,
-                     max_length=100, gv_dim=100):
-    train_X = train_X.reshape(len(train_labels), max_length, gv_dim)
-    model = build_LSTM_model(max_length=max_length)
+                     max_length=100, gv_dim=100, embedding_matrix=None):
+    """train_X is either the feature matrix or a feature sequence (with the
+    labels in it, see make_feature_sequence)"""
+    model = build_LSTM_model(max_length=max_length,
+                             embedding_matrix=embedding_matrix)
     # model = build_attention_model(max_length=max_length)
-    result = model.fit(train_X, train_labels, epochs=20, batch_size=32)
+    if isinstance(train_X, FeatureBatches):
+        result = model.fit(train_X, epochs=20, **train_X.keras_kwargs)
+    else:
+        if embedding_matrix is None:
+            train_X = train_X.reshape(len(train_labels), max_length, gv_dim)
+        result = model.fit(train_X, train_labels, epochs=20, batch_size=32)
     print(result.history)
     model.save(model_file)
     # model.save_weights(model_file)
@@ -245,42 +590,97 @@ def train(data, labels, max_length, glove_handler, gv_dim=100):
 
 
 def train_full(data, labels, max_length, glove_handler,
-               model_file, gv_dim=100):
-    Xs = prep_data(data, max_length, glove_handler, gv_dim=gv_dim)
+               model_file, gv_dim=100, token_ids=False, stream=False,
+               workers=4, prepared=None):
+    """prepared (PreparedInstances of data/labels) is used for the vector
+    features instead of looking them up"""
+    vocab, embedding_matrix = None, None
+    if token_ids:
+        vocab, embedding_matrix = build_vocab(data, glove_handler, gv_dim=gv_dim)
+    if stream:
+        Xs = make_feature_sequence(data, labels, max_length, glove_handler,
+                                   gv_dim=gv_dim, vocab=vocab, shuffle=True,
+                                   workers=workers)
+    elif token_ids:
+        Xs = prep_token_ids(data, max_length, vocab)
+    elif prepared is not None:
+        Xs = prepared.get_features()
+    else:
+        Xs = prep_data(data, max_length, glove_handler, gv_dim=gv_dim)
     train_model_full(Xs, labels, model_file, max_length=max_length,
-                     gv_dim=gv_dim)
+                     gv_dim=gv_dim, embedding_matrix=embedding_matrix)
+    vocab_file = get_vocab_file(model_file)
+    if vocab is None:
+        # a vocabulary left by an earlier token id model does not belong
+        # to this model
+        if os.path.isfile(vocab_file):
+            os.remove(vocab_file)
+            print("removed stale vocabulary:", vocab_file)
+        return
+    save_vocab(vocab, vocab_file)
+    print("saved vocabulary:", vocab_file)
+
+
+def predict_chunks(model, chunk_inputs, batch_size=256):
+    """scores (1D) of the instances of a sequence of model input chunks with
+    one model.predict call per chunk"""
+    y_preds = [model.predict(X, batch_size=batch_size,
+                             **getattr(X, 'keras_kwargs', {})).reshape(-1)
+               for X in chunk_inputs]
+    if not y_preds:
+        return np.zeros(0, dtype='float32')
+    return np.concatenate(y_preds)
 
 
 def evaluate(xml_file, nlp, glove_handler,
-             model_file='junk_remover_model.h5', threshold=0.01):
+             model_file='junk_remover_model.h5', threshold=0.01,
+             stream=False, workers=4, cache=None, batch_size=256,
+             chunk_pages=100, use_numpy=False):
     max_length = 100
     gv_dim = 100
     # model = build_LSTM_model(max_length=max_length)
     # model = build_attention_model(max_length=max_length)
     # model.load_weights(model_file)
-    model = keras.models.load_model(model_file,
-                                    custom_objects=SeqSelfAttention.get_custom_objects())
+    if use_numpy:
+        model = load_model(model_file, use_numpy=True)
+    else:
+        from keras_self_attention import SeqSelfAttention
+        model = load_model(model_file,
+                           custom_objects=SeqSelfAttention.get_custom_objects())
     # orig
     # model = keras.models.load_model(model_file)
-    page_sections = extract_page_sections(xml_file)
-    preds_all = []
-    labels_all = []
-    y_preds_all = []
-    for page_idx, sections in page_sections.items():
-        data, labels = prepare_section_tr_data(sections, nlp, max_length)
-        pred_X = prep_data(data, max_length, glove_handler, gv_dim=gv_dim)
-        pred_X = pred_X.reshape(len(labels), max_length, gv_dim)
-        y_preds = model.predict(pred_X)
-        # import pdb; pdb.set_trace()
-        labels_all.extend(labels)
-        preds_all.extend([1 if x >= threshold else 0 for x in y_preds])
-        y_preds_all.extend(y_preds)
+    prepared = prepare_xml_file(xml_file, nlp, glove_handler, max_length,
+                                gv_dim=gv_dim, cache=cache)
+
+    def chunk_inputs():
+        # chunk_pages pages at a time
+        num_pages = prepared.num_pages()
+        for page_idx in range(0, num_pages, chunk_pages):
+            start, end = prepared.get_range(page_idx, min(num_pages, page_idx + chunk_pages))
+            if start == end:
+                continue
+            if stream and use_numpy:
+                # batches featurized on the fly without keras
+                yield FeatureBatches(prepared.slice_data(start, end), None,
+                                     max_length, glove_handler, gv_dim=gv_dim,
+                                     batch_size=batch_size)
+            elif stream:
+                yield make_feature_sequence(prepared.slice_data(start, end), None,
+                                            max_length, glove_handler,
+                                            gv_dim=gv_dim, batch_size=batch_size,
+                                            workers=workers)
+            else:
+                yield prepared.slice_features(start, end)
+
+    y_preds_all = predict_chunks(model, chunk_inputs(), batch_size=batch_size)
+    labels_all = prepared.get_labels()
+    preds_all = (y_preds_all >= threshold).astype('int64')
     precs, recalls, thresholds = precision_recall_curve(labels_all,
                                                         y_preds_all)
     pickle.dump({'precs': precs, 'recalls': recalls, 'thresholds': thresholds},
                 open('good_prc.p', 'wb'))
-    bad_labels = [1 - x for x in labels_all]
-    by_preds = [1.0 - y for y in y_preds_all]
+    bad_labels = 1 - labels_all
+    by_preds = 1.0 - y_preds_all
     precs, recalls, thresholds = precision_recall_curve(bad_labels,
                                                         by_preds)
     pickle.dump({'precs': precs, 'recalls': recalls, 'thresholds': thresholds},
@@ -293,34 +693,41 @@ def evaluate(xml_file, nlp, glove_handler,
 
 
 def filter(xml_file, nlp, glove_handler, out_xml_file,
-           model_file='junk_remover_model.h5', threshold=0.5):
+           model_file='junk_remover_model.h5', threshold=0.5,
+           batch_size=256, chunk_pages=100, use_numpy=False):
     max_length = 100
     gv_dim = 100
     # model = build_LSTM_model(max_length=max_length)
     # model.load('junk_remover_model.h5')
-    model = keras.models.load_model(model_file)
+    model = load_model(model_file, use_numpy=use_numpy)
     # model._make_predict_function()
     page_sections = extract_page_sections(xml_file)
-    top = Element('pdf')
-    for page_idx, sections in page_sections.items():
-        assert len(sections) == 1
-        data, labels = prepare_section_tr_data(sections, nlp, max_length)
-        pred_X = prep_data(data, max_length, glove_handler, gv_dim=gv_dim)
-        pred_X = pred_X.reshape(len(labels), max_length, gv_dim)
-        y_preds = model.predict(pred_X)
-        lines = sections[0].lines
-        content = ""
-        for i, ypred in enumerate(y_preds):
-            if ypred > threshold:
-                print(lines[i])
-                content += lines[i] + "\n"
-        page_el = SubElement(top, 'page')
-        page_el.text = content
-        print('-'*80)
-
-    utils.indent(top)
-    out_tree = ET.ElementTree(top)
-    out_tree.write(out_xml_file, encoding="UTF-8")
+    page_indices = list(page_sections.keys())
+    with utils.XMLStreamWriter(out_xml_file, 'pdf') as writer:
+        for chunk_start in range(0, len(page_indices), chunk_pages):
+            # featurize and predict the lines of chunk_pages pages at once
+            chunk = page_indices[chunk_start:chunk_start + chunk_pages]
+            data = []
+            offsets = [0]
+            for page_idx in chunk:
+                sections = page_sections[page_idx]
+                assert len(sections) == 1
+                page_data, _ = prepare_section_tr_data(sections, nlp, max_length)
+                data.extend(page_data)
+                offsets.append(len(data))
+            pred_X = featurize(data, max_length, glove_handler, gv_dim=gv_dim)
+            y_preds = predict_chunks(model, [pred_X] if data else [],
+                                     batch_size=batch_size)
+            for k, page_idx in enumerate(chunk):
+                lines = np.array(page_sections[page_idx][0].lines, dtype=object)
+                kept = lines[y_preds[offsets[k]:offsets[k + 1]] > threshold]
+                content = ""
+                for line in kept:
+                    print(line)
+                    content += line + "\n"
+                writer.write_text('page', content)
+                print('-'*80)
+
     print("wrote file:", out_xml_file)
     print('done.')
 
@@ -346,6 +753,26 @@ def main():
     parser.add_argument('-o', action='store',
                         help="cleaned XML file (in clean mode)")
     parser.add_argument('-m', action='store', help="classifier model file")
+    parser.add_argument('-g', action='store',
+                        help="GloVe SQLite DB or .npy export (see glove_handler.py)")
+    parser.add_argument('--token-ids', action='store_true',
+                        help="train on token ids with a frozen GloVe embedding layer "
+                             "(the vocabulary is saved next to the model file)")
+    parser.add_argument('--stream', action='store_true',
+                        help="featurize batches on the fly in train and eval modes")
+    parser.add_argument('--workers', action='store', type=int, default=4,
+                        help="number of batch featurization threads in stream mode (default: 4)")
+    parser.add_argument('--cache-dir', action='store',
+                        help="directory caching the featurized instances of the input "
+                             "XML file (train and eval modes)")
+    parser.add_argument('--batch-size', action='store', type=int, default=256,
+                        help="model.predict batch size in eval and clean modes (default: 256)")
+    parser.add_argument('--chunk-pages', action='store', type=int, default=100,
+                        help="number of pages featurized and predicted at once in eval and "
+                             "clean modes (default: 100)")
+    parser.add_argument('--numpy', action='store_true',
+                        help="run the (BiLSTM) classifier with NumPy instead of TensorFlow "
+                             "in eval and clean modes (see numpy_model.py)")
     args = parser.parse_args()
 
     cmd = args.c
@@ -356,27 +783,35 @@ def main():
 
     home = expanduser("~")
     # db_file = home + "/medline_glove_v2.db"
-    db_file = home + "/pmd_2021_01_abstracts_glove.db"
+    db_file = args.g if args.g else home + "/pmd_2021_01_abstracts_glove.db"
     model_file = args.m if args.m else 'junk_remover_model.h5'
 
     nlp = spacy.load("en_core_web_sm")
     print("loaded spacy.")
-    glove_handler = GloveHandler(db_file)
+    glove_handler = open_glove_handler(db_file)
     max_length = 100
 
+    cache = FeatureCache(args.cache_dir) if args.cache_dir else None
     if cmd == 'train':
-        training_sections = extract_sections(in_file)
-        data, labels = prepare_section_tr_data(training_sections, nlp,
-                                               max_length)
-        train_full(data, labels, max_length, glove_handler, model_file)
+        prepared = prepare_xml_file(in_file, nlp, glove_handler, max_length,
+                                    training=True, cache=cache)
+        train_full(prepared.get_data(), prepared.get_labels(), max_length,
+                   glove_handler, model_file, token_ids=args.token_ids,
+                   stream=args.stream, workers=args.workers, prepared=prepared)
     elif cmd == 'eval':
-        evaluate(in_file, nlp, glove_handler, model_file=model_file)
+        evaluate(in_file, nlp, glove_handler, model_file=model_file,
+                 stream=args.stream, workers=args.workers, cache=cache,
+                 batch_size=args.batch_size, chunk_pages=args.chunk_pages,
+                 use_numpy=args.numpy)
     else:
         if not args.o:
             usage(parser)
         out_xml_file = args.o
         filter(in_file, nlp, glove_handler, out_xml_file,
-               model_file=model_file)
+               model_file=model_file, batch_size=args.batch_size,
+               chunk_pages=args.chunk_pages, use_numpy=args.numpy)
+    if cache and cmd in ('train', 'eval'):
+        print_cache_stats(cache)
 
 
 def test_driver():
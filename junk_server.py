@@ -0,0 +1,223 @@
+import json
+import time
+import queue
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from os.path import expanduser
+
+import numpy as np
+
+import utils
+from glove_handler import open_glove_handler
+import junk_remover
+
+
+class BatchPredictor(object):
+    """Runs model.predict from a single thread over the inputs of concurrent
+    callers. Inputs arriving within max_wait seconds of the first queued one
+    (up to max_batch_size instances) are predicted in one batch."""
+
+    def __init__(self, model, max_batch_size=2048, max_wait=0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.num_batches = 0
+        self.num_instances = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def predict(self, X):
+        if len(X) == 0:
+            return np.zeros((0, 1), dtype='float32')
+        request = {'X': X, 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['y']
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        size = len(batch[0]['X'])
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request['X'])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                X = np.concatenate([request['X'] for request in batch])
+                y = self.model.predict(X, batch_size=min(len(X), 1024), verbose=0)
+                self.num_batches += 1
+                self.num_instances += len(X)
+                offset = 0
+                for request in batch:
+                    request['y'] = y[offset:offset + len(request['X'])]
+                    offset += len(request['X'])
+            except Exception as e:
+                for request in batch:
+                    request['error'] = e
+            for request in batch:
+                request['done'].set()
+
+
+class JunkCleaner(object):
+    """Keeps spaCy, the GloVe handler and the junk classifier loaded and
+    cleans page texts the same way as junk_remover.filter"""
+
+    def __init__(self, nlp, glove_handler, model_file, max_length=100,
+                 gv_dim=100, threshold=0.5, max_batch_size=2048, max_wait=0.01,
+                 use_numpy=False):
+        self.nlp = nlp
+        self.glove_handler = glove_handler
+        self.max_length = max_length
+        self.gv_dim = gv_dim
+        self.threshold = threshold
+        self.predictor = BatchPredictor(junk_remover.load_model(model_file,
+                                                                use_numpy=use_numpy),
+                                        max_batch_size=max_batch_size,
+                                        max_wait=max_wait)
+        self.nlp_lock = threading.Lock()
+
+    def clean_pages(self, texts, threshold=None):
+        if threshold is None:
+            threshold = self.threshold
+        page_lines = []
+        data = []
+        for text in texts:
+            sections = []
+            junk_remover.handle_page_text(text, sections)
+            if len(sections) != 1:
+                raise ValueError("page text with {junk} annotation markers")
+            with self.nlp_lock:
+                page_data, _ = junk_remover.prepare_section_tr_data(
+                    sections, self.nlp, self.max_length)
+            page_lines.append(sections[0].lines)
+            data.extend(page_data)
+        X = junk_remover.featurize(data, self.max_length, self.glove_handler,
+                                   gv_dim=self.gv_dim)
+        y_preds = self.predictor.predict(X)
+        contents = []
+        offset = 0
+        for lines in page_lines:
+            content = ""
+            for i, ypred in enumerate(y_preds[offset:offset + len(lines)]):
+                if ypred > threshold:
+                    content += lines[i] + "\n"
+            offset += len(lines)
+            contents.append(content)
+        return contents
+
+
+def parse_request(request):
+    """returns the page texts and the threshold (or None) of a /clean request,
+    raises ValueError if the request is malformed"""
+    if not isinstance(request, dict):
+        raise ValueError("request must be a JSON object")
+    texts = request.get('pages')
+    if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+        raise ValueError("'pages' must be a list of strings")
+    for text in texts:
+        # annotated pages would be split into several sections
+        if any(line.startswith('{junk}') for line in text.split('\n')):
+            raise ValueError("'pages' must not contain {junk} annotation markers")
+    threshold = request.get('threshold')
+    if threshold is not None and (isinstance(threshold, bool) or
+                                  not isinstance(threshold, (int, float))):
+        raise ValueError("'threshold' must be a number")
+    return texts, threshold
+
+
+class JunkRequestHandler(BaseHTTPRequestHandler):
+    """POST /clean with {"pages": [page text, ...], "threshold": optional}
+    returns {"pages": [cleaned page text, ...]}"""
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_error(404)
+            return
+        predictor = self.server.cleaner.predictor
+        self._send_json({'status': 'ok', 'batches': predictor.num_batches,
+                         'instances': predictor.num_instances})
+
+    def do_POST(self):
+        if self.path != '/clean':
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            texts, threshold = parse_request(request)
+            pages = self.server.cleaner.clean_pages(texts, threshold=threshold)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        self._send_json({'pages': pages})
+
+    def _send_json(self, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(cleaner, host='127.0.0.1', port=8765):
+    server = ThreadingHTTPServer((host, port), JunkRequestHandler)
+    server.daemon_threads = True
+    server.cleaner = cleaner
+    print("serving on http://{}:{}".format(host, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="junk remover cleaning server "
+                                                 "(see junk_client.py)")
+    parser.add_argument('-m', action='store', help="classifier model file")
+    parser.add_argument('-g', action='store',
+                        help="GloVe SQLite DB or .npy export (see glove_handler.py)")
+    parser.add_argument('--host', action='store', default='127.0.0.1',
+                        help="host to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', action='store', type=int, default=8765,
+                        help="port to listen on (default: 8765)")
+    parser.add_argument('--max-batch-size', action='store', type=int, default=2048,
+                        help="max number of lines per model.predict batch (default: 2048)")
+    parser.add_argument('--max-wait-ms', action='store', type=float, default=10,
+                        help="how long to wait for more lines to batch (default: 10)")
+    parser.add_argument('--numpy', action='store_true',
+                        help="run the (BiLSTM) classifier with NumPy instead of TensorFlow")
+    args = parser.parse_args()
+
+    home = expanduser("~")
+    db_file = args.g if args.g else home + "/pmd_2021_01_abstracts_glove.db"
+    model_file = args.m if args.m else 'junk_remover_model.h5'
+    nlp = utils.load_nlp()
+    print("loaded spacy.")
+    cleaner = JunkCleaner(nlp, open_glove_handler(db_file), model_file,
+                          max_batch_size=args.max_batch_size,
+                          max_wait=args.max_wait_ms / 1000.0,
+                          use_numpy=args.numpy)
+    serve(cleaner, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
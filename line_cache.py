@@ -0,0 +1,92 @@
+import sqlite3
+import hashlib
+import json
+import time
+
+from utils import Token
+
+
+class LineFeatureCache:
+    """Content addressed on-disk cache of the per-line token features
+    (see utils.LineAnnotator) keyed by a hash of the line text and the
+    spaCy model name/version. Least recently used lines are evicted once
+    the cache holds more than max_entries lines."""
+
+    def __init__(self, db_file, model_id, max_entries=1000000):
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(db_file)
+        cursor = self.conn.cursor()
+        cursor.execute("create table if not exists line_features "
+                       "(key text primary key, features text, "
+                       "last_used real)")
+        cursor.execute("create index if not exists line_features_lu_idx "
+                       "on line_features (last_used)")
+        self.conn.commit()
+        cursor.close()
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def make_key(self, line):
+        content = self.model_id + '\n' + line
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def get_many(self, lines, chunk_size=500):
+        """returns a dict of line to token features for the given lines
+        found in the cache"""
+        key2line = {self.make_key(line): line for line in lines}
+        keys = list(key2line.keys())
+        found = {}
+        cursor = self.conn.cursor()
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i+chunk_size]
+            sql = "select key, features from line_features where key in ({})".format(
+                ",".join("?" * len(chunk)))
+            cursor.execute(sql, chunk)
+            for key, features in cursor.fetchall():
+                found[key2line[key]] = [Token(*t) for t in json.loads(features)]
+        if found:
+            now = time.time()
+            cursor.executemany("update line_features set last_used = ? where key = ?",
+                               [(now, self.make_key(line)) for line in found])
+            self.conn.commit()
+        cursor.close()
+        self.hits += len(found)
+        self.misses += len(key2line) - len(found)
+        return found
+
+    def put_many(self, line_features):
+        """stores a dict of line to token features"""
+        if not line_features:
+            return
+        now = time.time()
+        rows = [(self.make_key(line), json.dumps([list(t) for t in tokens]), now)
+                for line, tokens in line_features.items()]
+        cursor = self.conn.cursor()
+        cursor.executemany("insert or replace into line_features "
+                           "(key, features, last_used) values (?, ?, ?)", rows)
+        self.conn.commit()
+        cursor.close()
+        self.evict()
+
+    def evict(self):
+        cursor = self.conn.cursor()
+        cursor.execute("select count(*) from line_features")
+        size = cursor.fetchone()[0]
+        if size > self.max_entries:
+            cursor.execute("delete from line_features where key in "
+                           "(select key from line_features order by last_used "
+                           "limit ?)", (size - self.max_entries,))
+            self.conn.commit()
+        cursor.close()
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        hit_ratio = self.hits / float(total) if total > 0 else 0.0
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': hit_ratio}
@@ -0,0 +1,297 @@
+import json
+import argparse
+
+import h5py
+import numpy as np
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def hard_sigmoid_keras2(x):
+    return np.clip(0.2 * x + 0.5, 0.0, 1.0)
+
+
+def hard_sigmoid_keras3(x):
+    return np.clip(x / 6.0 + 0.5, 0.0, 1.0)
+
+
+def relu(x):
+    return np.maximum(x, 0.0)
+
+
+def linear(x):
+    return x
+
+
+ACTIVATIONS = {'sigmoid': sigmoid, 'tanh': np.tanh, 'relu': relu,
+               'linear': linear, None: linear}
+
+
+def get_activation(name, keras_version='3'):
+    if isinstance(name, dict):
+        # serialized activation
+        name = name.get('config', {}).get('name', name.get('class_name'))
+    if name == 'hard_sigmoid':
+        if str(keras_version).startswith('2'):
+            return hard_sigmoid_keras2
+        return hard_sigmoid_keras3
+    if name not in ACTIVATIONS:
+        raise ValueError("unsupported activation: {}".format(name))
+    return ACTIVATIONS[name]
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class LSTMLayer(object):
+    def __init__(self, kernel, recurrent_kernel, bias, activation,
+                 recurrent_activation, return_sequences=False,
+                 go_backwards=False):
+        self.kernel = kernel
+        self.recurrent_kernel = recurrent_kernel
+        self.bias = bias
+        self.activation = activation
+        self.recurrent_activation = recurrent_activation
+        self.return_sequences = return_sequences
+        self.go_backwards = go_backwards
+        self.units = recurrent_kernel.shape[0]
+
+    def __call__(self, X):
+        """X: (batch, time, features)"""
+        batch_size, num_steps = X.shape[0], X.shape[1]
+        units = self.units
+        # input projections of all the time steps at once
+        Z = X.reshape(batch_size * num_steps, -1) @ self.kernel
+        Z = Z.reshape(batch_size, num_steps, 4 * units)
+        if self.bias is not None:
+            Z += self.bias
+        h = np.zeros((batch_size, units), dtype=X.dtype)
+        c = np.zeros((batch_size, units), dtype=X.dtype)
+        steps = range(num_steps - 1, -1, -1) if self.go_backwards else range(num_steps)
+        outputs = []
+        for t in steps:
+            z = Z[:, t] + h @ self.recurrent_kernel
+            i = self.recurrent_activation(z[:, :units])
+            f = self.recurrent_activation(z[:, units:2 * units])
+            c = f * c + i * self.activation(z[:, 2 * units:3 * units])
+            o = self.recurrent_activation(z[:, 3 * units:])
+            h = o * self.activation(c)
+            if self.return_sequences:
+                outputs.append(h)
+        if self.return_sequences:
+            return np.stack(outputs, axis=1)
+        return h
+
+
+class BidirectionalLayer(object):
+    def __init__(self, forward, backward, merge_mode='concat'):
+        if merge_mode not in ('concat', 'sum', 'mul', 'ave'):
+            raise ValueError("unsupported merge mode: {}".format(merge_mode))
+        self.forward = forward
+        self.backward = backward
+        self.merge_mode = merge_mode
+
+    def __call__(self, X):
+        y_fwd = self.forward(X)
+        y_bwd = self.backward(X)
+        if self.backward.return_sequences:
+            # back to the input order
+            y_bwd = y_bwd[:, ::-1]
+        if self.merge_mode == 'concat':
+            return np.concatenate([y_fwd, y_bwd], axis=-1)
+        if self.merge_mode == 'sum':
+            return y_fwd + y_bwd
+        if self.merge_mode == 'mul':
+            return y_fwd * y_bwd
+        return (y_fwd + y_bwd) / 2.0
+
+
+class DenseLayer(object):
+    def __init__(self, kernel, bias, activation):
+        self.kernel = kernel
+        self.bias = bias
+        self.activation = activation
+
+    def __call__(self, X):
+        y = X @ self.kernel
+        if self.bias is not None:
+            y += self.bias
+        return self.activation(y)
+
+
+class EmbeddingLayer(object):
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def __call__(self, X):
+        return self.embeddings[X.astype(np.int64)]
+
+
+class FlattenLayer(object):
+    def __call__(self, X):
+        return X.reshape(X.shape[0], -1)
+
+
+class NumpyModel(object):
+    """Forward pass of a saved (.h5) Sequential junk classifier
+    (junk_remover.build_LSTM_model / build_attention_model) in NumPy, for
+    inference without TensorFlow. Supports Embedding, (Bidirectional) LSTM,
+    Flatten and Dense layers."""
+
+    def __init__(self, layers, input_shape=None):
+        self.layers = layers
+        # shape of an instance (without the batch dimension), if known
+        self.input_shape = input_shape
+
+    @classmethod
+    def load(cls, model_file):
+        with h5py.File(model_file, 'r') as f:
+            keras_version = _decode(f.attrs.get('keras_version', '3'))
+            config = json.loads(_decode(f.attrs['model_config']))
+            weights_group = f['model_weights'] if 'model_weights' in f else f
+            layer_configs = config['config']
+            if isinstance(layer_configs, dict):
+                layer_configs = layer_configs['layers']
+            layers = []
+            input_shape = None
+            for layer_config in layer_configs:
+                batch_shape = (layer_config['config'].get('batch_shape') or
+                               layer_config['config'].get('batch_input_shape'))
+                if input_shape is None and batch_shape:
+                    input_shape = tuple(batch_shape[1:])
+                weights = cls._get_layer_weights(weights_group,
+                                                 layer_config['config']['name'])
+                layer = cls._build_layer(layer_config, weights, keras_version)
+                if layer is not None:
+                    layers.append(layer)
+        return cls(layers, input_shape=input_shape)
+
+    @staticmethod
+    def _get_layer_weights(weights_group, name):
+        if name not in weights_group:
+            return []
+        group = weights_group[name]
+        weight_names = [_decode(n) for n in group.attrs.get('weight_names', [])]
+        return [np.asarray(group[n], dtype=np.float32) for n in weight_names]
+
+    @staticmethod
+    def _build_lstm(config, weights, keras_version, go_backwards=False):
+        use_bias = config.get('use_bias', True)
+        kernel, recurrent_kernel = weights[0], weights[1]
+        bias = weights[2] if use_bias else None
+        return LSTMLayer(kernel, recurrent_kernel, bias,
+                         get_activation(config.get('activation', 'tanh'), keras_version),
+                         get_activation(config.get('recurrent_activation', 'sigmoid'),
+                                        keras_version),
+                         return_sequences=config.get('return_sequences', False),
+                         go_backwards=go_backwards or config.get('go_backwards', False))
+
+    @classmethod
+    def _build_layer(cls, layer_config, weights, keras_version):
+        class_name = layer_config['class_name']
+        config = layer_config['config']
+        if class_name in ('InputLayer', 'Dropout'):
+            return None
+        if class_name == 'Embedding':
+            return EmbeddingLayer(weights[0])
+        if class_name == 'Flatten':
+            return FlattenLayer()
+        if class_name == 'Dense':
+            bias = weights[1] if config.get('use_bias', True) else None
+            return DenseLayer(weights[0], bias,
+                              get_activation(config.get('activation'), keras_version))
+        if class_name == 'LSTM':
+            return cls._build_lstm(config, weights, keras_version)
+        if class_name == 'Bidirectional':
+            inner = config['layer']
+            if inner['class_name'] != 'LSTM':
+                raise ValueError("unsupported Bidirectional layer: {}".format(
+                    inner['class_name']))
+            num_weights = len(weights) // 2
+            forward = cls._build_lstm(inner['config'], weights[:num_weights],
+                                      keras_version)
+            backward = cls._build_lstm(inner['config'], weights[num_weights:],
+                                       keras_version, go_backwards=True)
+            return BidirectionalLayer(forward, backward,
+                                      merge_mode=config.get('merge_mode', 'concat'))
+        raise ValueError("unsupported layer: {}".format(class_name))
+
+    def predict(self, X, batch_size=1024, verbose=0, **kwargs):
+        """same output as keras Model.predict (verbose and the Keras 2
+        prefetching arguments are ignored). X is an array or a batch
+        sequence (e.g. junk_remover.FeatureBatches), whose batches are used
+        as they are."""
+        outputs = []
+        for batch in self._iter_batches(X, batch_size):
+            y = np.asarray(batch)
+            if y.dtype != np.float32 and not np.issubdtype(y.dtype, np.integer):
+                y = y.astype(np.float32)
+            for layer in self.layers:
+                y = layer(y)
+            outputs.append(y.astype(np.float32))
+        if not outputs:
+            return np.zeros((0, 1), dtype=np.float32)
+        return np.concatenate(outputs)
+
+    @staticmethod
+    def _iter_batches(X, batch_size):
+        if isinstance(X, (np.ndarray, list)):
+            for start in range(0, len(X), batch_size):
+                yield X[start:start + batch_size]
+            return
+        for i in range(len(X)):
+            batch = X[i]
+            # (inputs, labels) batches of a training sequence
+            yield batch[0] if isinstance(batch, tuple) else batch
+
+    def make_random_input(self, num_instances, seed=0):
+        """random model input: token ids for models starting with an
+        Embedding layer, standard normal vectors otherwise"""
+        if self.input_shape is None or None in self.input_shape:
+            raise ValueError("unknown model input shape: {}".format(self.input_shape))
+        rng = np.random.default_rng(seed)
+        shape = (num_instances,) + self.input_shape
+        if self.layers and isinstance(self.layers[0], EmbeddingLayer):
+            return rng.integers(0, len(self.layers[0].embeddings), size=shape)
+        return rng.standard_normal(shape).astype(np.float32)
+
+
+def verify_numpy_model(model_file, X, atol=1e-4, custom_objects=None):
+    """compares the NumpyModel predictions for X with the keras ones. Returns
+    whether they match within atol and the max absolute difference."""
+    import keras
+    keras_model = keras.models.load_model(model_file, custom_objects=custom_objects)
+    y_keras = keras_model.predict(X, verbose=0)
+    y_numpy = NumpyModel.load(model_file).predict(X)
+    max_diff = float(np.max(np.abs(y_keras - y_numpy))) if len(X) else 0.0
+    return max_diff <= atol, max_diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NumPy inference for a saved (.h5) "
+                                                 "junk classifier")
+    parser.add_argument('-m', action='store', help="classifier model file", required=True)
+    parser.add_argument('--verify', action='store_true',
+                        help="compare the predictions with keras on random input")
+    parser.add_argument('-n', action='store', type=int, default=64,
+                        help="number of random instances for --verify (default: 64)")
+    parser.add_argument('--atol', action='store', type=float, default=1e-4,
+                        help="max absolute difference for --verify (default: 1e-4)")
+    args = parser.parse_args()
+
+    model = NumpyModel.load(args.m)
+    print("input shape:", model.input_shape)
+    print("layers:", ", ".join(type(layer).__name__ for layer in model.layers))
+    if args.verify:
+        X = model.make_random_input(args.n)
+        match, max_diff = verify_numpy_model(args.m, X, atol=args.atol)
+        print("match: {} max abs diff: {:.3g}".format(match, max_diff))
+        if not match:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,33 @@
 import re
+import itertools
 import numpy as np
 import argparse
 from xml.etree.ElementTree import Element, SubElement
 import xml.etree.ElementTree as ET
-import spacy
 import utils
+from line_cache import LineFeatureCache
+import pdftext2pages
 
 
 def isempty(line):
     return not line.strip()
 
 
-def is_same(text1, text2):
-    if text1 == text2:
-        return True
-    text1 = re.sub(r'\s+', '', text1)
-    text2 = re.sub(r'\s+', '', text2)
-    return text1 == text2
+def remove_line_numbers(lines, keep_empty):
+    """if at least half of the lines start with a line number, keeps only
+    those (and the empty lines if keep_empty) with the numbers removed"""
+    matches = [utils.LINE_NUMBER_PAT.match(line) for line in lines]
+    line_no_count = sum(1 for m in matches if m)
+    fraction = line_no_count / float(len(lines))
+    if fraction < 0.5:
+        return lines
+    numbered = []
+    for line, m in zip(lines, matches):
+        if m:
+            numbered.append(line[m.end():])
+        elif keep_empty and isempty(line):
+            numbered.append(line)
+    return numbered
 
 
 class Table:
@@ -27,13 +38,17 @@ class Table:
     def add_2body(self, body):
         self.body += body
 
-    def to_xml(self, top):
-        sect_el = SubElement(top, 'table')
+    def to_element(self):
+        sect_el = Element('table')
         title_el = SubElement(sect_el, 'title')
         title_el.text = self.title
         if self.body:
             body_el = SubElement(sect_el, 'body')
             body_el.text = self.body
+        return sect_el
+
+    def to_xml(self, top):
+        top.append(self.to_element())
 
 
 class Section:
@@ -48,8 +63,8 @@ class Section:
     def add_table(self, table: Table):
         self.tables.append(table)
 
-    def to_xml(self, top):
-        sect_el = SubElement(top, 'section')
+    def to_element(self):
+        sect_el = Element('section')
         title_el = SubElement(sect_el, 'title')
         title_el.text = self.title
         if self.body:
@@ -58,6 +73,10 @@ class Section:
         if self.tables:
             for table in self.tables:
                 table.to_xml(sect_el)
+        return sect_el
+
+    def to_xml(self, top):
+        top.append(self.to_element())
 
 
 class Page:
@@ -67,57 +86,27 @@ class Page:
         self.median_sent_len = None
         self.header_indices = []
         self.headings_detected = False
+        self.features = None
 
     def extract_lines(self, text):
-        self.lines = text.split('\n')
-        cleaned = []
-        line_no_count = 0
-        for line in self.lines:
-            line = line.replace('\f', '')
-            m = re.search(r'^\d+ ', line)
-            if m:
-                line_no_count += 1
-            cleaned.append(line)
-        # import pdb; pdb.set_trace()
-        fraction = line_no_count / float(len(self.lines))
-        if fraction >= 0.5:
-            self.lines = []
-            for line in cleaned:
-                m = re.search(r'^\d+ ', line)
-                if m:
-                    line = re.sub(r'^\d+ ', '', line)
-                    self.lines.append(line)
-                elif isempty(line):
-                    self.lines.append(line)
-        else:
-            self.lines = cleaned
+        cleaned = [line.replace('\f', '') for line in text.split('\n')]
+        self.lines = remove_line_numbers(cleaned, keep_empty=True)
 
         sl = [len(line) for line in self.lines if len(line.strip()) > 0]
         print(sl)
         self.median_sent_len = np.median(sl)
 
     def to_text(self):
-        cleaned = []
-        line_no_count = 0
-        for line in self.lines:
-            line = line.strip()
-            line = line.replace('\f', '')
-            m = re.search(r'^\d+ ', line)
-            if m:
-                line_no_count += 1
-            cleaned.append(line)
-        fraction = line_no_count / float(len(self.lines))
-        if fraction >= 0.5:
-            self.lines = []
-            for line in cleaned:
-                m = re.search(r'^\d+ ', line)
-                if m:
-                    line = re.sub(r'^\d+ ', '', line)
-                    self.lines.append(line)
-        else:
-            self.lines = cleaned
+        cleaned = [line.strip().replace('\f', '') for line in self.lines]
+        self.lines = remove_line_numbers(cleaned, keep_empty=False)
         return "\n".join(self.lines)
 
+    def get_features(self):
+        """line features of the current lines, computed once"""
+        if self.features is None or self.features.lines is not self.lines:
+            self.features = utils.LineFeatures(self.lines, self.median_sent_len)
+        return self.features
+
     def __len__(self):
         return len(self.lines)
 
@@ -142,18 +131,18 @@ class Page:
         if idx > 0:
             self.lines = self.lines[idx:]
 
-    def _is_eligible_heading(self, line, i, num_lines, msl, nlp):
-        ok, known_title = utils.is_heading(line, nlp)
+    def _is_eligible_heading(self, line, i, num_lines, msl, classifier):
+        ok, known_title = classifier.is_heading(line)
         if known_title:
             return True
         if ok and i+1 < num_lines:
             if isempty(self.lines[i+1]):
                 return True
-            if utils.is_par_start(self.lines[i+1], msl, nlp):
+            if classifier.is_par_start(self.lines[i+1], msl):
                 return True
         return False
 
-    def detect_headings(self, nlp):
+    def detect_headings(self, classifier):
         if self.headings_detected:
             return
         num_lines = len(self.lines)
@@ -166,16 +155,16 @@ class Page:
                     continue
             if i == 0:
                 if i+1 < num_lines:
-                    if self._is_eligible_heading(line, i, num_lines, msl, nlp):
+                    if self._is_eligible_heading(line, i, num_lines, msl, classifier):
                         self.header_indices.append(i)
                         prev_header = True
             else:
                 if isempty(self.lines[i-1]):
-                    if self._is_eligible_heading(line, i, num_lines, msl, nlp):
+                    if self._is_eligible_heading(line, i, num_lines, msl, classifier):
                         self.header_indices.append(i)
                         prev_header = True
                 else:
-                    if self._is_eligible_heading(line, i, num_lines, msl, nlp):
+                    if self._is_eligible_heading(line, i, num_lines, msl, classifier):
                         self.header_indices.append(i)
                         prev_header = True
 
@@ -205,10 +194,107 @@ class Page:
         return s
 
 
+class RunningLines:
+    """Hash index of the lines recurring at the top (running headers) or
+    at the bottom (running footers) of pages. Lines are compared with
+    whitespace removed and digit runs replaced, so varying page numbers
+    and dates still match, and they are counted separately for odd and
+    even pages to catch alternating headers. If sample_size is given,
+    only that many evenly spaced pages are indexed."""
+    ws_pat = re.compile(r'\s+')
+    digits_pat = re.compile(r'\d+')
+    page_no_pat = re.compile(r'^\s*\d+\s*$')
+
+    def __init__(self, pages, top_k=10, bottom_k=5, threshold=0.75,
+                 sample_size=None):
+        self.top_k = top_k
+        self.bottom_k = bottom_k
+        if sample_size and len(pages) > sample_size:
+            step = len(pages) / float(sample_size)
+            pages = [pages[int(i * step)] for i in range(sample_size)]
+        self.headers = self._find_recurring(pages, top_k, threshold, from_top=True)
+        self.footers = self._find_recurring(pages, bottom_k, threshold, from_top=False)
+        if self.headers:
+            print('>>> Header lines:', len(self.headers))
+        if self.footers:
+            print('>>> Footer lines:', len(self.footers))
+
+    @classmethod
+    def normalize(cls, line):
+        return cls.ws_pat.sub('', cls.digits_pat.sub('#', line))
+
+    @classmethod
+    def _edge_keys(cls, lines, k, from_top):
+        keys = set()
+        num_checked = 0
+        for line in (lines if from_top else reversed(lines)):
+            if num_checked == k:
+                break
+            if not isempty(line):
+                keys.add(cls.normalize(line))
+                num_checked += 1
+        return keys
+
+    @classmethod
+    def _find_recurring(cls, pages, k, threshold, from_top):
+        counts = {}
+        num_pages = [0, 0]
+        for page in pages:
+            parity = page.page_id % 2
+            num_pages[parity] += 1
+            for key in cls._edge_keys(page.lines, k, from_top):
+                if key not in counts:
+                    counts[key] = [0, 0]
+                counts[key][parity] += 1
+        recurring = set()
+        total_pages = num_pages[0] + num_pages[1]
+        for key, pc in counts.items():
+            total = pc[0] + pc[1]
+            if total >= 2 and total >= threshold * total_pages:
+                recurring.add(key)
+            elif any(pc[i] >= 2 and pc[i] >= threshold * num_pages[i]
+                     for i in range(2)):
+                recurring.add(key)
+        return recurring
+
+    def strip(self, page):
+        if self.headers:
+            idx = -1
+            num_checked = 0
+            for i, line in enumerate(page.lines):
+                if isempty(line):
+                    # blank lines go with the header lines before them
+                    if idx >= 0:
+                        idx = i
+                    continue
+                num_checked += 1
+                if num_checked > self.top_k or self.normalize(line) not in self.headers:
+                    break
+                idx = i
+            if idx >= 0:
+                page.lines = page.lines[idx+1:]
+        idx = -1
+        num_checked = 0
+        for i, line in enumerate(reversed(page.lines)):
+            if isempty(line) or self.page_no_pat.match(line):
+                idx = i + 1
+                continue
+            num_checked += 1
+            if num_checked > self.bottom_k or self.normalize(line) not in self.footers:
+                break
+            idx = i + 1
+        if idx > 0:
+            page.lines = page.lines[:-idx]
+
+
 class Doc:
-    def __init__(self):
+    def __init__(self, on_section=None):
+        """if on_section is given, it is called with each section as soon
+        as it is complete instead of keeping the section in self.sections"""
         self.pages = []
         self.sections = []
+        self.on_section = on_section
+        self.cur_section = None
 
     def add_page(self, page: Page):
         self.pages.append(page)
@@ -216,159 +302,261 @@ class Doc:
     def __len__(self):
         return len(self.pages)
 
-    def _remove_footers(self):
-        pat = re.compile(r'^\s*\d+\s*$')
+    @staticmethod
+    def _annotate(pages, annotator, classifier):
+        """tags every distinct line the heading, paragraph start and table
+        predicates may need the tagger for in batched spaCy passes"""
+        lines = []
+        for page in pages:
+            for line in page.lines:
+                if classifier.heading_needs_tagging(line):
+                    heading_text, _ = utils.split_section_number(line)
+                    lines.append(heading_text)
+        annotator.annotate(lines)
+        # paragraph starts are checked for the line after a heading
+        # candidate and for the lines of a table body, which can only
+        # follow a table heading on the same page
+        lines = []
+        for page in pages:
+            after_table_heading = False
+            features = page.get_features()
+            for i, line in enumerate(page.lines):
+                candidate = after_table_heading
+                if i > 0 and utils.is_heading(page.lines[i-1], annotator)[0]:
+                    candidate = True
+                if candidate and classifier.par_start_needs_tagging(line):
+                    lines.append(line)
+                if features.table_prefixes[i]:
+                    after_table_heading = True
+        annotator.annotate(lines)
+
+    def _start_section(self, title):
+        if self.on_section is not None and self.cur_section is not None:
+            self.on_section(self.cur_section)
+        self.cur_section = Section(title)
+        if self.on_section is None:
+            self.sections.append(self.cur_section)
+        return self.cur_section
+
+    def _finish(self, classifier):
+        if self.on_section is not None and self.cur_section is not None:
+            self.on_section(self.cur_section)
+        self.cur_section = None
+        classifier.print_report()
+
+    def process(self, nlp, batch_size=1000, n_process=1, cache=None,
+                sample_size=None):
+        running_lines = RunningLines(self.pages, sample_size=sample_size)
         for page in self.pages:
-            idx = -1
-            for i, line in enumerate(reversed(page.lines)):
-                if isempty(line):
-                    idx = i + 1
-                else:
-                    m = pat.match(line)
-                    if m:
-                        idx = i + 1
-                    else:
-                        break
-            if idx > 0:
-                page.lines = page.lines[:-idx]
-
-    def _remove_headers(self):
-        # import pdb; pdb.set_trace()
-        header = ""
-        for lidx in range(0, 10):
-            ref_line = None
-            same_count = 1
-            for i, page in enumerate(self.pages):
-                if i == 0:
-                    if lidx < len(page):
-                        ref_line = page.lines[lidx]
+            running_lines.strip(page)
+        annotator = utils.LineAnnotator(nlp, batch_size=batch_size,
+                                        n_process=n_process, cache=cache)
+        classifier = utils.RuleCascade(annotator, tokenizer=nlp.tokenizer)
+        self._annotate(self.pages, annotator, classifier)
+        for page in self.pages:
+            self._process_page(page, classifier)
+        self._finish(classifier)
+
+    def process_stream(self, pages, nlp, sample_size=10, chunk_size=20,
+                       batch_size=1000, n_process=1, cache=None):
+        """processes pages from an iterable without keeping them around.
+        Running headers and footers are detected from the first sample_size pages
+        and pages are tagged and processed chunk_size pages at a time"""
+        pages = iter(pages)
+        chunk = list(itertools.islice(pages, sample_size))
+        if not chunk:
+            return
+        running_lines = RunningLines(chunk)
+        annotator = utils.LineAnnotator(nlp, batch_size=batch_size,
+                                        n_process=n_process, cache=cache)
+        classifier = utils.RuleCascade(annotator, tokenizer=nlp.tokenizer)
+        while chunk:
+            for page in chunk:
+                running_lines.strip(page)
+            self._annotate(chunk, annotator, classifier)
+            for page in chunk:
+                self._process_page(page, classifier)
+            # only the features of the lines in the current chunk are needed
+            annotator.clear()
+            chunk = list(itertools.islice(pages, chunk_size))
+        self._finish(classifier)
+
+    def _process_page(self, page, classifier):
+        page.detect_headings(classifier)
+        lt_list = [lt for lt in page.get_lines()]
+        page_len = len(lt_list)
+        in_table = False
+        cur_table = None
+        skip_next = False
+        table_start_idx = -1
+        msl = page.get_median_sent_len()
+        features = page.get_features()
+        for i, lt in enumerate(lt_list):
+            line, is_heading = lt
+            if skip_next:
+                skip_next = False
+                continue
+            next_line = lt_list[i+1][0] if i+1 < page_len else None
+            is_last_line = i+1 == page_len
+            if not self.cur_section:
+                if is_heading:
+                    self._start_section(line)
+                    print('1 Section({})'.format(line))
                 else:
-                    if ref_line and lidx < len(page):
-                        line = page.lines[lidx]
-                        if is_same(ref_line, line):
-                            same_count += 1
-            fraction = same_count / float(len(self.pages))
-            if fraction >= 0.75:
-                header += ref_line + ' '
+                    self._start_section('')
+                self.cur_section.add_2body(line + '\n')
+                continue
+            if is_heading and not in_table:
+                self._start_section(line)
+                print('2 Section({})'.format(line))
             else:
-                break
-        header = header.strip()
-        if header:
-            print('>>> Header:', header)
-            for page in self.pages:
-                idx = -1
-                for lidx in range(0, 10):
-                    if lidx < len(page):
-                        line = page.lines[lidx].strip()
-                        if header.find(line) != -1:
-                            idx = lidx
-                        else:
-                            break
-                if idx >= 0:
-                    page.lines = page.lines[idx+1:]
-
-    def process(self, nlp):
-        self._remove_headers()
-        self._remove_footers()
-        cur_section = None
-        for page in self.pages:
-            page.detect_headings(nlp)
-            lt_list = [lt for lt in page.get_lines()]
-            page_len = len(lt_list)
-            in_table = False
-            cur_table = None
-            skip_next = False
-            table_start_idx = -1
-            msl = page.get_median_sent_len()
-            for i, lt in enumerate(lt_list):
-                line, is_heading = lt
-                if skip_next:
-                    skip_next = False
-                    continue
-                prev_line = lt_list[i-1][0] if i > 0 else None
-                next_line = lt_list[i+1][0] if i+1 < page_len else None
-                is_last_line = i+1 == page_len
-                if not cur_section:
-                    if is_heading:
-                        cur_section = Section(line)
-                        print('1 Section({})'.format(line))
+                if not in_table:
+                    t = features.is_table_heading(i, next_line)
+                    if t:
+                        table_title = t[0]
+                        skip_next = t[1]
+                        cur_table = Table(table_title)
+                        print('1 Table({})'.format(table_title))
+                        self.cur_section.add_table(cur_table)
+                        in_table = True
+                        table_start_idx = i
                     else:
-                        cur_section = Section('')
-                    self.sections.append(cur_section)
-                    cur_section.add_2body(line + '\n')
-                    continue
-                if is_heading and not in_table:
-                    cur_section = Section(line)
-                    print('2 Section({})'.format(line))
-                    self.sections.append(cur_section)
+                        if not features.can_be_ignored(i):
+                            self.cur_section.add_2body(line + '\n')
                 else:
-                    if not in_table:
-                        t = utils.is_table_heading(line, prev_line, next_line)
-                        if t:
-                            table_title = t[0]
-                            skip_next = t[1]
-                            cur_table = Table(table_title)
-                            print('1 Table({})'.format(table_title))
-                            cur_section.add_table(cur_table)
-                            in_table = True
-                            table_start_idx = i
+                    if classifier.is_par_start(line, msl):
+                        if table_start_idx > 0 and i < table_start_idx + 5:
+                            cur_table.add_2body(line + '\n')
                         else:
-                            if not utils.can_line_be_ignored(line, msl):
-                                cur_section.add_2body(line + '\n')
+                            in_table = False
+                            cur_table = None
+                            table_start_idx = -1
+                            if not features.can_be_ignored(i):
+                                self.cur_section.add_2body(line + '\n')
                     else:
-                        if utils.is_par_start(line, msl, nlp):
-                            if table_start_idx > 0 and i < table_start_idx + 5:
-                                cur_table.add_2body(line + '\n')
-                            else:
-                                in_table = False
-                                cur_table = None
-                                table_start_idx = -1
-                                if not utils.can_line_be_ignored(line, msl):
-                                    cur_section.add_2body(line + '\n')
-                        else:
-                            if not utils.can_line_be_ignored(line, msl):
-                                cur_table.add_2body(line + '\n')
-                            if is_last_line:
-                                in_table = False
-                                cur_table = None
+                        if not features.can_be_ignored(i):
+                            cur_table.add_2body(line + '\n')
+                        if is_last_line:
+                            in_table = False
+                            cur_table = None
 
-    def to_xml(self, out_file):
+    def to_element(self):
         top = Element('paper')
         for section in self.sections:
             section.to_xml(top)
-        utils.indent(top)
-        tree = ET.ElementTree(top)
-        tree.write(out_file, encoding='utf-8')
+        return top
+
+    def to_xml(self, out_file):
+        with utils.XMLStreamWriter(out_file, 'paper') as writer:
+            for section in self.sections:
+                writer.write(section.to_element())
         print("wrote file:", out_file)
 
 
+def iter_pages(page_texts):
+    for i, text in enumerate(page_texts):
+        if not text:
+            continue
+        page = Page(i+1)
+        page.extract_lines(text)
+        print('# of lines in page:{} median sentence length:{}'.format(
+            len(page), page.get_median_sent_len()))
+        yield page
+
+
+def iter_page_texts(xml_file):
+    """yields the page texts of a pdftext2pages.py XML file one page at
+    a time without building the whole tree"""
+    root = None
+    for event, el in ET.iterparse(xml_file, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = el
+        elif el.tag == 'page':
+            yield el.text
+            root.clear()
+
+
+def build_doc(page_texts):
+    doc = Doc()
+    for page in iter_pages(page_texts):
+        doc.add_page(page)
+    print('# of pages:{}'.format(len(doc)))
+    return doc
+
+
+def convert_text(text, nlp=None, model_name='en_core_web_sm',
+                 batch_size=1000, n_process=1, cache=None):
+    """converts pdftotext output to a processed Doc in memory, i.e.
+    without going through the pdf.xml file of pdftext2pages.py"""
+    if nlp is None:
+        nlp = utils.load_nlp(model_name)
+    # same line end normalization as parsing pdf.xml would do
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    doc = build_doc(pdftext2pages.split_pages(text))
+    doc.process(nlp, batch_size=batch_size, n_process=n_process, cache=cache)
+    return doc
+
+
+def convert_pdf(pdf_file, nlp=None, model_name='en_core_web_sm',
+                batch_size=1000, n_process=1, cache=None):
+    """converts a PDF file to a processed Doc using pdftotext"""
+    text = pdftext2pages.pdf_to_text(pdf_file)
+    return convert_text(text, nlp=nlp, model_name=model_name,
+                        batch_size=batch_size, n_process=n_process,
+                        cache=cache)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', action='store', help="input PDF XML file", required=True)
     parser.add_argument('-o', action='store', help="output XML file", required=True)
+    parser.add_argument('--model', action='store', default='en_core_web_sm',
+                        help="spaCy model name (default: en_core_web_sm)")
+    parser.add_argument('--batch-size', action='store', type=int, default=1000,
+                        help="number of lines per spaCy batch (default: 1000)")
+    parser.add_argument('--n-process', action='store', type=int, default=1,
+                        help="number of spaCy worker processes (default: 1)")
+    parser.add_argument('--cache', action='store',
+                        help="SQLite file caching line features across runs")
+    parser.add_argument('--cache-size', action='store', type=int, default=1000000,
+                        help="max number of lines kept in the cache (default: 1000000)")
+    parser.add_argument('--stream', action='store_true',
+                        help="process pages one at a time in bounded memory")
+    parser.add_argument('--sample-pages', action='store', type=int,
+                        help="number of pages used to detect running headers "
+                             "and footers (default: all pages, the 10 leading "
+                             "pages in stream mode)")
 
     args = parser.parse_args()
 
     in_file = args.i
     out_file = args.o
 
-    nlp = spacy.load("en_core_web_sm")
+    nlp = utils.load_nlp(args.model)
     print("loaded spacy.")
 
-    tree = ET.parse(in_file)
-    root = tree.getroot()
-
-    doc = Doc()
-    for i, child in enumerate(root):
-        if not child.text:
-            continue
-        text = child.text
-        page = Page(i+1)
-        page.extract_lines(text)
-        print('# of lines in page:{} median sentence length:{}'.format(
-            len(page), page.get_median_sent_len()))
-        doc.add_page(page)
-
-    print('# of pages:{}'.format(len(doc)))
-    doc.process(nlp)
-    doc.to_xml(out_file)
+    cache = None
+    if args.cache:
+        cache = LineFeatureCache(args.cache, utils.get_model_id(nlp),
+                                 max_entries=args.cache_size)
+    if args.stream:
+        with utils.XMLStreamWriter(out_file, 'paper') as writer:
+            doc = Doc(on_section=lambda section: writer.write(section.to_element()))
+            doc.process_stream(iter_pages(iter_page_texts(in_file)), nlp,
+                               sample_size=args.sample_pages or 10,
+                               batch_size=args.batch_size,
+                               n_process=args.n_process, cache=cache)
+        print("wrote file:", out_file)
+    else:
+        tree = ET.parse(in_file)
+        root = tree.getroot()
+        doc = build_doc([child.text for child in root])
+        doc.process(nlp, batch_size=args.batch_size, n_process=args.n_process,
+                    cache=cache, sample_size=args.sample_pages)
+        doc.to_xml(out_file)
+    if cache:
+        stats = cache.get_stats()
+        print('line cache hits:{} misses:{} hit ratio:{:.2f}'.format(
+            stats['hits'], stats['misses'], stats['hit_ratio']))
+        cache.close()
@@ -1,9 +1,26 @@
 import os
 import argparse
-from xml.etree.ElementTree import Element, SubElement
-import xml.etree.ElementTree as ET
+import subprocess
 import utils
 
+
+def pdf_to_text(pdf_file):
+    """runs pdftotext on the PDF file and returns its text output"""
+    result = subprocess.run(['pdftotext', pdf_file, '-'],
+                            stdout=subprocess.PIPE, check=True)
+    return result.stdout.decode('utf-8')
+
+
+def split_pages(content):
+    """splits pdftotext output into page texts stripped of control characters"""
+    pages = []
+    for text in content.split('\f'):
+        for i in [1, 2, 3, 4, 5, 6, 7, 14, 15, 16, 17, 18, 19, 20, 21]:
+            text = text.replace(chr(i), '')
+        pages.append(text)
+    return pages
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', action='store', help="input PDF Text file", required=True)
@@ -20,17 +37,8 @@ if __name__ == '__main__':
     with open(pdf_file, 'r') as f:
         content = f.read()
 
-    pages = content.split('\f')
-
     out_file = out_dir + "/pdf.xml"
-    top = Element('pdf')
-    for text in pages:
-        for i in [1, 2, 3, 4, 5, 6, 7, 14, 15, 16, 17, 18, 19, 20, 21]:
-            text = text.replace(chr(i), '')
-        page_el = SubElement(top, 'page')
-        page_el.text = text
-
-    utils.indent(top)
-    tree = ET.ElementTree(top)
-    tree.write(out_file, encoding='UTF-8')
+    with utils.XMLStreamWriter(out_file, 'pdf') as writer:
+        for text in split_pages(content):
+            writer.write_text('page', text)
     print("wrote file:", out_file)
@@ -1,5 +1,3 @@
-from xml.etree.ElementTree import Element, SubElement
-import xml.etree.ElementTree as ET
 import os.path
 from os.path import join
 import spacy
@@ -7,9 +5,10 @@ import spacy
 import utils
 import numpy as np
 from junk_remover import extract_page_sections
-from junk_remover import extract_sections, prepare_section_tr_data, train_full
-from junk_remover import evaluate
+from junk_remover import prepare_xml_file, train_full
+from junk_remover import evaluate, print_cache_stats
 from glove_handler import GloveHandler
+from feature_cache import FeatureCache
 
 
 class PageStats(object):
@@ -33,28 +32,24 @@ def prep_page_stats(xml_file):
 
 
 def write_page_range(out_file, pg_list, start, end):
-    top = Element('pdf')
-    for i in range(start, end):
-        pg = pg_list[i]
-        content = ""
-        for section in pg.sections:
-            if section.sec_type == 'bad':
-                nl = len(section.lines)
-                for j, line in enumerate(section.lines):
-                    if j == 0:
-                        content += '{junk}' + line + "\n"
-                    elif j == nl - 1:
-                        content += line + "{junk}\n"
-                    else:
+    with utils.XMLStreamWriter(out_file, 'pdf') as writer:
+        for i in range(start, end):
+            pg = pg_list[i]
+            content = ""
+            for section in pg.sections:
+                if section.sec_type == 'bad':
+                    nl = len(section.lines)
+                    for j, line in enumerate(section.lines):
+                        if j == 0:
+                            content += '{junk}' + line + "\n"
+                        elif j == nl - 1:
+                            content += line + "{junk}\n"
+                        else:
+                            content += line + "\n"
+                else:
+                    for line in section.lines:
                         content += line + "\n"
-            else:
-                for line in section.lines:
-                    content += line + "\n"
-        page_el = SubElement(top, 'page')
-        page_el.text = content
-    utils.indent(top)
-    out_tree = ET.ElementTree(top)
-    out_tree.write(out_file, encoding="UTF-8")
+            writer.write_text('page', content)
     print("wrote file:", out_file)
 
 
@@ -77,7 +72,7 @@ def prep_splits(pg_list, out_dir, prefix):
         write_page_range(test_file, pg_list, i, len(pg_list))
 
 
-def train_test_splits(out_dir, prefix, result_file):
+def train_test_splits(out_dir, prefix, result_file, cache_dir=None):
     import glob
     home = os.path.expanduser("~")
     db_file = home + "/pmd_2021_01_abstracts_glove.db"
@@ -88,6 +83,8 @@ def train_test_splits(out_dir, prefix, result_file):
     models_dir = join(out_dir, 'models')
     if not os.path.exists(models_dir):
         os.makedirs(models_dir)
+    # featurized instances are reused across runs (see FeatureCache)
+    cache = FeatureCache(cache_dir if cache_dir else join(out_dir, 'cache'))
 
     with open(result_file, 'w') as f:
         for i in range(1, 10):
@@ -99,14 +96,16 @@ def train_test_splits(out_dir, prefix, result_file):
             print(model_file)
             comp = 100 - int(split_perc)
             f.write("{}/{} split\n".format(split_perc, str(comp)))
-            training_sections = extract_sections(tr_file)
-            data, labels = prepare_section_tr_data(training_sections, nlp,
-                                                   max_length)
-            train_full(data, labels, max_length, glove_handler, model_file)
+            prepared = prepare_xml_file(tr_file, nlp, glove_handler, max_length,
+                                        training=True, cache=cache)
+            train_full(prepared.get_data(), prepared.get_labels(), max_length,
+                       glove_handler, model_file, prepared=prepared)
             # evaluate
-            r = evaluate(tst_file, nlp, glove_handler, model_file=model_file)
+            r = evaluate(tst_file, nlp, glove_handler, model_file=model_file,
+                         cache=cache)
             print(f"Good P:{r['p_good']:.2f} R:{r['r_good']:.2f} F1:{r['f1_good']:.2f}", file=f)
             print(f"Bad  P:{r['p_bad']:.2f} R:{r['r_bad']:.2f} F1:{r['f1_bad']:.2f}", file=f)
+    print_cache_stats(cache)
 
 
 
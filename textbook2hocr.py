@@ -0,0 +1,113 @@
+import os
+import glob
+import json
+import time
+import argparse
+import uuid
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def is_up_to_date(pdf_file, html_file):
+    if not os.path.isfile(html_file):
+        return False
+    return os.path.getmtime(html_file) >= os.path.getmtime(pdf_file)
+
+
+def pdf_to_hocr(pdf_file, html_file, timeout=None):
+    """runs pdftotree on a PDF file writing its stdout to a temp file next to
+    html_file, which is renamed to html_file only if the conversion succeeds.
+    Returns a manifest record."""
+    out_dir = os.path.dirname(html_file) or '.'
+    # a unique name opened with 'x' (unlike mkstemp) gets the umask permissions
+    tmp_file = os.path.join(out_dir, '.{}.{}.tmp'.format(os.path.basename(html_file),
+                                                         uuid.uuid4().hex))
+    record = {'pdf': pdf_file, 'html': html_file}
+    start = time.time()
+    try:
+        with open(tmp_file, 'xb') as out:
+            proc = subprocess.run(['pdftotree', pdf_file], stdout=out,
+                                  stderr=subprocess.PIPE, timeout=timeout)
+        if proc.returncode == 0:
+            os.replace(tmp_file, html_file)
+            record['status'] = 'ok'
+        else:
+            record['status'] = 'failed'
+            record['error'] = proc.stderr.decode('utf-8', errors='replace')[-2000:]
+    except subprocess.TimeoutExpired:
+        record['status'] = 'timeout'
+    except OSError as e:
+        record['status'] = 'failed'
+        record['error'] = str(e)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    record['duration'] = round(time.time() - start, 3)
+    return record
+
+
+def convert_all(pdf_dir, out_dir, num_workers=None, timeout=None,
+                manifest_file=None, force=False):
+    """converts all PDF files in pdf_dir to pdftotree HOCR files in out_dir
+    with a pool of num_workers concurrent pdftotree processes. Outputs newer
+    than their PDF are skipped unless force is set. A JSON record per file
+    is appended to the manifest file. Returns the records."""
+    os.makedirs(out_dir, exist_ok=True)
+    # temp files left by a killed run
+    for tmp_file in glob.glob(os.path.join(out_dir, '.*.html*.tmp')):
+        os.remove(tmp_file)
+    if manifest_file is None:
+        manifest_file = os.path.join(out_dir, 'manifest.jsonl')
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    records = []
+    todo = []
+    for pdf_file in sorted(glob.glob(os.path.join(pdf_dir, '*.pdf'))):
+        prefix = os.path.splitext(os.path.basename(pdf_file))[0]
+        html_file = os.path.join(out_dir, prefix + '.html')
+        if not force and is_up_to_date(pdf_file, html_file):
+            records.append({'pdf': pdf_file, 'html': html_file,
+                            'status': 'skipped', 'duration': 0.0})
+        else:
+            todo.append((pdf_file, html_file))
+    print("{} PDF files to convert, {} up to date".format(len(todo), len(records)))
+    with open(manifest_file, 'a') as mf:
+        for record in records:
+            mf.write(json.dumps(record) + '\n')
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(pdf_to_hocr, pdf_file, html_file, timeout)
+                       for pdf_file, html_file in todo]
+            for future in as_completed(futures):
+                record = future.result()
+                print("{} {} ({:.1f}s)".format(record['status'], record['pdf'],
+                                              record['duration']))
+                mf.write(json.dumps(record) + '\n')
+                mf.flush()
+                records.append(record)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', action='store', help="textbook PDF directory", required=True)
+    parser.add_argument('-o', action='store', help="HOCR output directory", required=True)
+    parser.add_argument('-j', action='store', type=int, default=None,
+                        help="number of concurrent pdftotree processes (default: #CPUs)")
+    parser.add_argument('--timeout', action='store', type=float, default=None,
+                        help="per file timeout in seconds (default: none)")
+    parser.add_argument('--manifest', action='store', default=None,
+                        help="JSON lines manifest file (default: <output dir>/manifest.jsonl)")
+    parser.add_argument('--force', action='store_true',
+                        help="convert also the files with up to date outputs")
+
+    args = parser.parse_args()
+    records = convert_all(args.i, args.o, num_workers=args.j, timeout=args.timeout,
+                          manifest_file=args.manifest, force=args.force)
+    counts = {}
+    for record in records:
+        counts[record['status']] = counts.get(record['status'], 0) + 1
+    print(counts)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,11 @@
 #!/bin/bash
 
 #
-# usage: $0 <textbook-pdf-dir> <hocr-output-dir>
-# 
-mkdir -p $2
-for x in `ls $1/*.pdf`; do
-    echo $x
-    prefix=`basename $x .pdf`
-    echo $prefix
-    pdftotree $x > $2/${prefix}.html
-done
+# usage: $0 <textbook-pdf-dir> <hocr-output-dir> [textbook2hocr.py options]
+#
+# see textbook2hocr.py (-j, --timeout, --manifest, --force)
+#
+in_dir=$1
+out_dir=$2
+shift 2
+python `dirname $0`/textbook2hocr.py -i $in_dir -o $out_dir "$@"
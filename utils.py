@@ -1,5 +1,7 @@
 import re
 import unicodedata
+from collections import namedtuple
+import xml.etree.ElementTree as ET
 
 '''
 copy and paste from http://effbot.org/zone/element-lib.htm#prettyprint
@@ -8,6 +10,44 @@ printed in a nice way
 '''
 
 
+TABLE_HEADING_PAT = re.compile(r'(^s*Table\s+\d+[\.:]?\s+)[A-Z]')
+NUMBER_PAT = re.compile(r'-?\d+(\.\d+)?')
+BRACKETS_PAT = re.compile(r'[\(\)\[\]]')
+PAREN_NUMBER_PAT = re.compile(r'\(\d+\)')
+SEC_NUM_PAT = re.compile(r'(^\s*\d+\.[\d+.]*\s)')
+ALPHA_SEC_PAT = re.compile(r'(\^[abcdefg]\.\s*)')
+LINE_NUMBER_PAT = re.compile(r'^\d+ ')
+TITLE_CASE_SHAPE_PAT = re.compile(r'^X[x]+$')
+ALL_CAPS_SHAPE_PAT = re.compile(r'^X[X\.]+$')
+
+# pipeline components the line heuristics never read
+UNUSED_PIPES = ['parser', 'ner', 'lemmatizer', 'senter', 'textcat']
+
+_nlp_cache = {}
+
+
+def load_nlp(model_name='en_core_web_sm'):
+    """loads a spaCy model with only the components needed for the
+    token tags, shapes and alpha flags the line heuristics use. The
+    loaded pipeline is shared by all callers in the process."""
+    if model_name not in _nlp_cache:
+        import spacy
+        if spacy.__version__.startswith('2.'):
+            # spaCy 2.x has no exclude (and silently ignores it)
+            nlp = spacy.load(model_name, disable=UNUSED_PIPES)
+        else:
+            nlp = spacy.load(model_name, exclude=UNUSED_PIPES)
+        _nlp_cache[model_name] = nlp
+    return _nlp_cache[model_name]
+
+
+def get_model_id(nlp):
+    """language, name and version of a spaCy pipeline, for cache keys"""
+    meta = nlp.meta
+    return "{}_{}-{}".format(meta.get('lang'), meta.get('name'),
+                             meta.get('version'))
+
+
 def indent(elem, level=0):
     i = "\n" + level*"  "
     if len(elem):
@@ -24,22 +64,71 @@ def indent(elem, level=0):
             elem.tail = i
 
 
+class XMLStreamWriter(object):
+    """Writes an XML document one top level element at a time, with the
+    same layout indent() followed by ElementTree.write() would produce,
+    so the whole tree never needs to be in memory."""
+
+    def __init__(self, out_file, root_tag, buffer_size=1 << 20):
+        self.out_file = out_file
+        self.root_tag = root_tag
+        self.num_written = 0
+        self.out = open(out_file, 'w', encoding='utf-8',
+                        errors='xmlcharrefreplace', buffering=buffer_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, elem):
+        if self.num_written == 0:
+            self.out.write('<{}>'.format(self.root_tag))
+        indent(elem, 1)
+        elem.tail = None
+        self.out.write('\n  ')
+        self.out.write(ET.tostring(elem, encoding='unicode'))
+        self.num_written += 1
+
+    def write_text(self, tag, text):
+        elem = ET.Element(tag)
+        elem.text = text
+        self.write(elem)
+
+    def close(self):
+        if self.out is None:
+            return
+        if self.num_written == 0:
+            self.out.write('<{} />'.format(self.root_tag))
+        else:
+            self.out.write('\n</{}>\n'.format(self.root_tag))
+        self.out.close()
+        self.out = None
+
+
 def isempty(line):
     return not line.strip()
 
 
-def is_table_heading(line, prev_line, next_line):
-    pat = re.compile(r'(^s*Table\s+\d+[\.:]?\s+)[A-Z]')
-    m = pat.match(line)
-    if m:
-        prefix = m.group(1)
-        heading = line.replace(prefix, '').strip()
-        if not next_line or isempty(next_line):
-            return (heading, False)
-        else:
-            heading += ' ' + next_line
-            return (heading, True)
+def get_table_heading_prefix(line):
+    m = TABLE_HEADING_PAT.match(line)
+    return m.group(1) if m else None
+
+
+def table_heading_from_prefix(line, prefix, next_line):
+    heading = line.replace(prefix, '').strip()
+    if not next_line or isempty(next_line):
+        return (heading, False)
+    else:
+        heading += ' ' + next_line
+        return (heading, True)
 
+
+def is_table_heading(line, prev_line, next_line):
+    prefix = get_table_heading_prefix(line)
+    if prefix:
+        return table_heading_from_prefix(line, prefix, next_line)
     return None
 
 
@@ -49,43 +138,135 @@ def can_follow_verb(token):
 
 
 def is_mostly_numbers(line):
-    num_spans = []
-    for m in re.finditer(r'-?\d+(\.\d+)?', line):
-        num_spans.append((m.start(), m.end()))
-    if len(num_spans) > 0:
+    numbers = []
+    for m in NUMBER_PAT.finditer(line):
+        number = m.group(0)
+        # replace() below drops all occurrences at once
+        if number not in numbers:
+            numbers.append(number)
+    if len(numbers) > 0:
         rem = line
-        for ns in num_spans:
-            number = line[ns[0]:ns[1]]
+        for number in numbers:
             rem = rem.replace(number, '')
-        rem = re.sub(r'[\(\)\[\]]', '', rem)
+        rem = BRACKETS_PAT.sub('', rem)
         rem_ratio = len(rem) / float(len(line))
         if rem_ratio <= 0.15:
             return True
     return False
 
 
-def is_figure_text(line_toks, nlp):
+# the subset of spaCy token attributes the line predicates read
+Token = namedtuple('Token', ['text', 'tag_', 'shape_', 'is_alpha'])
+
+
+def get_token_features(doc):
+    return [Token(t.text, t.tag_, t.shape_, t.is_alpha) for t in doc]
+
+
+class LineAnnotator(object):
+    """Tags lines with spaCy in batches and keeps the token features
+    per distinct line text, so it can be passed to the line predicates
+    in place of the spaCy pipeline. If a persistent cache
+    (line_cache.LineFeatureCache) is given, only lines missing from it
+    are tagged."""
+
+    def __init__(self, nlp, batch_size=1000, n_process=1, cache=None):
+        self.nlp = nlp
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.cache = cache
+        self.features = {}
+
+    def annotate(self, lines):
+        todo = []
+        seen = set()
+        for line in lines:
+            if line in self.features or line in seen:
+                continue
+            seen.add(line)
+            todo.append(line)
+        if self.cache and todo:
+            cached = self.cache.get_many(todo)
+            self.features.update(cached)
+            todo = [line for line in todo if line not in cached]
+        if not todo:
+            return
+        docs = self.nlp.pipe(todo, batch_size=self.batch_size,
+                             n_process=self.n_process,
+                             disable=['ner', 'parser'])
+        tagged = {}
+        for line, doc in zip(todo, docs):
+            tagged[line] = get_token_features(doc)
+        self.features.update(tagged)
+        if self.cache:
+            self.cache.put_many(tagged)
+
+    def clear(self):
+        self.features = {}
+
+    def get_tokens(self, line):
+        if line not in self.features:
+            self.annotate([line])
+        return self.features[line]
+
+
+def tag_line(line, nlp):
+    if isinstance(nlp, LineAnnotator):
+        return nlp.get_tokens(line)
+    for doc in nlp.pipe([line], disable=['ner', 'parser']):
+        return doc
+
+
+def split_section_number(line):
+    """returns the line without its section number prefix (if any)
+    and whether there was one"""
+    m = SEC_NUM_PAT.match(line)
+    if m:
+        prefix = m.group(1)
+        return line.replace(prefix, '').strip(), True
+    m = ALPHA_SEC_PAT.match(line)
+    if m:
+        prefix = m.group(1)
+        return line.replace(prefix, '').strip(), True
+    return line, False
+
+
+def figure_text_rules(line_toks):
+    """decides is_figure_text() without tagging if possible. Returns the
+    deciding rule stage and the decision (None if the tagger is needed)"""
     if len(line_toks) >= 5:
-        return False
+        return 'long', False
+    if is_mostly_numbers(" ".join(line_toks)):
+        return 'numbers', True
+    return 'tagger', None
+
+
+def is_figure_text(line_toks, nlp):
+    stage, decision = figure_text_rules(line_toks)
+    if decision is not None:
+        return decision
+    return is_figure_text_tagged(line_toks, nlp)
+
+
+def is_figure_text_tagged(line_toks, nlp):
+    """the tagger part of is_figure_text() (without the figure_text_rules)"""
     has_title_case = False
     has_verb = False
     num_nouns = 0
     has_period = False
     line = " ".join(line_toks)
-    if is_mostly_numbers(line):
-        return True
-    for doc in nlp.pipe([line], disable=['ner', 'parser']):
-        num_tokens = len(doc)
-        for i, token in enumerate(doc):
-            if token.text == '.':
-                has_period = True
-            m = re.match(r'^X[x]+$', token.shape_)
-            if i == 0 and m:
-                has_title_case = True
-            if token.tag_.startswith('VB'):
-                has_verb = True
-            if token.tag_.startswith('NN'):
-                num_nouns += 1
+    doc = tag_line(line, nlp)
+    num_tokens = len(doc)
+    for i, token in enumerate(doc):
+        if token.text == '.':
+            has_period = True
+        m = TITLE_CASE_SHAPE_PAT.match(token.shape_)
+        if i == 0 and m:
+            has_title_case = True
+        if token.tag_.startswith('VB'):
+            has_verb = True
+        if token.tag_.startswith('NN'):
+            num_nouns += 1
 
     noun_frac = num_nouns / float(num_tokens) if num_tokens > 0 else 0
     if not has_verb and not has_period and noun_frac >= 0.5:
@@ -93,62 +274,71 @@ def is_figure_text(line_toks, nlp):
     return False
 
 
-def is_heading(line, nlp):
+def heading_rules(line):
+    """decides is_heading() without tagging if possible. Returns the
+    deciding rule stage and the decision (None if the tagger is needed)"""
     if isempty(line):
-        return (False, False)
-    all_capitals = True
-    has_verb = False
-    all_alpha = True
-    num_nouns = 0
-    has_period = False
-    has_title_case = False
-    has_sec_num = False
-    # num_tokens = 0
-    sec_num_pat = re.compile(r'(^\s*\d+\.[\d+.]*\s)')
-    alpha_sec_pat = re.compile(r'(\^[abcdefg]\.\s*)')
+        return 'empty', (False, False)
     headings_set = {"abstract", "introduction", "background", "methods",
                     "materials and methods", "discussion", "conclusions",
                     "references", "acknowledgements", "online methods",
                     "bibliography"}
-    m = sec_num_pat.match(line)
-    if m:
-        prefix = m.group(1)
-        has_sec_num = True
-        line = line.replace(prefix, '').strip()
-    else:
-        m = alpha_sec_pat.match(line)
-        if m:
-            prefix = m.group(1)
-            has_sec_num = True
-            line = line.replace(prefix, '').strip()
+    line, has_sec_num = split_section_number(line)
     ll = line.strip().lower()
     # handle cases like 'Methods:'
     if ll.endswith(':'):
         ll = ll[:len(ll)-1]
 
     if ll in headings_set:
-        return (True, True)
+        return 'known_heading', (True, True)
 
     if is_mostly_numbers(line):
-        return False, False
+        return 'numbers', (False, False)
 
-    for doc in nlp.pipe([line], disable=['ner', 'parser']):
-        num_tokens = len(doc)
-        for i, token in enumerate(doc):
-            if token.text == '.':
-                has_period = True
-            m = re.match(r'^X[X\.]+$', token.shape_)
-            if not m:
-                all_capitals = False
-            m = re.match(r'^X[x]+$', token.shape_)
-            if i == 0 and m:
-                has_title_case = True
-            if not token.is_alpha:
-                all_alpha = False
-            if token.tag_.startswith('VB'):
-                has_verb = True
-            if token.tag_.startswith('NN'):
-                num_nouns += 1
+    # Without a section number a heading needs either all capital tokens
+    # or a title case first token. The first token starts with the first
+    # character of the line (unless it is whitespace), so a line not
+    # starting with a capital letter can be neither.
+    if not has_sec_num and not line[0].isspace():
+        if not (line[0].isalpha() and line[0].isupper()):
+            return 'no_capital', (False, False)
+    return 'tagger', None
+
+
+def is_heading(line, nlp):
+    stage, decision = heading_rules(line)
+    if decision is not None:
+        return decision
+    return is_heading_tagged(line, nlp)
+
+
+def is_heading_tagged(line, nlp):
+    """the tagger part of is_heading() (without the heading_rules)"""
+    all_capitals = True
+    has_verb = False
+    all_alpha = True
+    num_nouns = 0
+    has_period = False
+    has_title_case = False
+    # num_tokens = 0
+    line, has_sec_num = split_section_number(line)
+    doc = tag_line(line, nlp)
+    num_tokens = len(doc)
+    for i, token in enumerate(doc):
+        if token.text == '.':
+            has_period = True
+        m = ALL_CAPS_SHAPE_PAT.match(token.shape_)
+        if not m:
+            all_capitals = False
+        m = TITLE_CASE_SHAPE_PAT.match(token.shape_)
+        if i == 0 and m:
+            has_title_case = True
+        if not token.is_alpha:
+            all_alpha = False
+        if token.tag_.startswith('VB'):
+            has_verb = True
+        if token.tag_.startswith('NN'):
+            num_nouns += 1
     # if has_verb:
     #     print("-- ", line)
     noun_frac = num_nouns / float(num_tokens)
@@ -164,23 +354,36 @@ def is_heading(line, nlp):
     return (False, False)
 
 
+def par_start_rules(line, tokenizer=None):
+    """decides is_par_start() without tagging if possible. Returns the
+    deciding rule stage and the decision (None if the tagger is needed).
+    Tokenization alone is much cheaper than tagging, so if a tokenizer is
+    given, lines too short to have a verb in the middle are decided too."""
+    if isempty(line):
+        return 'empty', False
+    # a verb as the first or last token does not count
+    if tokenizer is not None and len(tokenizer(line)) <= 2:
+        return 'few_tokens', False
+    return 'tagger', None
+
+
 def is_par_start(line, median_sent_len, nlp):
     if isempty(line):
         return False
     short_line = len(line) < int(0.5 * median_sent_len)
     has_verb = False
     num_nouns = 0
-    for doc in nlp.pipe([line]):
-        verb_idx = -1
-        no_toks = len(doc)
-        for i, token in enumerate(doc):
-            if token.tag_.startswith('VB'):
-                has_verb = True
-                verb_idx = i
-            if verb_idx > 0 and i == verb_idx+1 and not can_follow_verb(token):
-                has_verb = False
-            if token.tag_.startswith('NN'):
-                num_nouns += 1
+    doc = tag_line(line, nlp)
+    verb_idx = -1
+    no_toks = len(doc)
+    for i, token in enumerate(doc):
+        if token.tag_.startswith('VB'):
+            has_verb = True
+            verb_idx = i
+        if verb_idx > 0 and i == verb_idx+1 and not can_follow_verb(token):
+            has_verb = False
+        if token.tag_.startswith('NN'):
+            num_nouns += 1
     if has_verb and (verb_idx == 0 or verb_idx+1 == no_toks):
         has_verb = False
     if not has_verb:
@@ -190,7 +393,70 @@ def is_par_start(line, median_sent_len, nlp):
     return True
 
 
+class RuleCascade(object):
+    """Decides the heading, paragraph start and figure text predicates
+    with the cheap rules above first and only falls back to the tagger
+    (a spaCy pipeline or a LineAnnotator) for the remaining lines.
+    Keeps count of how many lines each rule stage decided."""
+
+    def __init__(self, nlp, tokenizer=None):
+        self.nlp = nlp
+        self.tokenizer = tokenizer
+        self.stage_counts = {}
+
+    def _count(self, predicate, stage):
+        key = (predicate, stage)
+        self.stage_counts[key] = self.stage_counts.get(key, 0) + 1
+
+    def heading_needs_tagging(self, line):
+        return heading_rules(line)[1] is None
+
+    def par_start_needs_tagging(self, line):
+        return par_start_rules(line, self.tokenizer)[1] is None
+
+    def is_heading(self, line):
+        stage, decision = heading_rules(line)
+        if decision is None:
+            decision = is_heading(line, self.nlp)
+        self._count('heading', stage)
+        return decision
+
+    def is_par_start(self, line, median_sent_len):
+        stage, decision = par_start_rules(line, self.tokenizer)
+        if decision is None:
+            decision = is_par_start(line, median_sent_len, self.nlp)
+        self._count('par_start', stage)
+        return decision
+
+    def is_figure_text(self, line_toks):
+        stage, decision = figure_text_rules(line_toks)
+        if decision is None:
+            decision = is_figure_text(line_toks, self.nlp)
+        self._count('figure_text', stage)
+        return decision
+
+    def report(self):
+        """returns the fraction of lines decided by each stage per predicate"""
+        totals = {}
+        for (predicate, stage), count in self.stage_counts.items():
+            totals[predicate] = totals.get(predicate, 0) + count
+        fractions = {}
+        for (predicate, stage), count in sorted(self.stage_counts.items()):
+            stages = fractions.setdefault(predicate, {})
+            stages[stage] = count / float(totals[predicate])
+        return fractions
+
+    def print_report(self):
+        for predicate, stages in self.report().items():
+            print('{} decided by: {}'.format(predicate, ', '.join(
+                '{} {:.2f}'.format(stage, frac) for stage, frac in stages.items())))
+
+
 def get_ascii_ratio(line):
+    if line.isascii():
+        # NFD leaves pure ASCII unchanged
+        tot_chars = len(line) - line.count(' ')
+        return tot_chars / float(tot_chars + 0.000001)
     t = unicodedata.normalize('NFD', line)
     tot_chars = 0
     tot_ascii = 0
@@ -202,7 +468,7 @@ def get_ascii_ratio(line):
     return tot_ascii / float(tot_chars + 0.000001)
 
 
-def can_line_be_ignored(line, median_sent_len):
+def can_line_be_ignored(line, median_sent_len, ascii_ratio=None):
     if isempty(line):
         return False
     if len(line) < 3:
@@ -210,9 +476,9 @@ def can_line_be_ignored(line, median_sent_len):
     if len(line) < 5:
         if line.isnumeric():
             return True
-        elif re.search(r'\(\d+\)', line):
+        elif PAREN_NUMBER_PAT.search(line):
             return True
-    ratio = get_ascii_ratio(line)
+    ratio = get_ascii_ratio(line) if ascii_ratio is None else ascii_ratio
     if median_sent_len > 40:
         if len(line) < median_sent_len/2:
             if ratio < 0.85:
@@ -222,6 +488,30 @@ def can_line_be_ignored(line, median_sent_len):
     return False
 
 
+class LineFeatures(object):
+    """Features of the lines of a page computed in a single pass, for the
+    table heading and ignorable line checks to look up instead of
+    recomputing them on every call"""
+
+    def __init__(self, lines, median_sent_len):
+        self.lines = lines
+        self.table_prefixes = [get_table_heading_prefix(line) for line in lines]
+        self.ascii_ratios = [None if isempty(line) else get_ascii_ratio(line)
+                             for line in lines]
+        self.ignorable = [
+            can_line_be_ignored(line, median_sent_len, ascii_ratio=ratio)
+            for line, ratio in zip(lines, self.ascii_ratios)]
+
+    def is_table_heading(self, i, next_line):
+        prefix = self.table_prefixes[i]
+        if prefix:
+            return table_heading_from_prefix(self.lines[i], prefix, next_line)
+        return None
+
+    def can_be_ignored(self, i):
+        return self.ignorable[i]
+
+
 def get_perf_results(true_labels, preds):
     """Calculates P, R, F1 both for good and bad labels"""
     n_bad_correct, n_bad_predicted, n_bad_gold = 0, 0, 0
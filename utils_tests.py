@@ -1,5 +1,14 @@
+import os
+import sqlite3
+import tempfile
+import numpy as np
 import spacy
 import utils
+import junk_remover
+from glove_handler import GloveHandler
+from numpy_model import NumpyModel, EmbeddingLayer, FlattenLayer, DenseLayer, sigmoid
+from paper2xml import Page, RunningLines
+from hocr2pages import BBox, bboxes_to_array, find_column_bounds, layout_columns
 
 
 def test_table_detect():
@@ -54,6 +63,205 @@ def test_is_mostly_numbers():
     print(x)
 
 
+RULE_TEST_LINES = ['the results are shown below', '(see Table 2)', 'e.g. protein levels',
+                   'and Methods', '[12] Smith et al. reported', '12 34 56', '(87.0-94.5))',
+                   '3.5 4.2 %', 'Results', 'We observed', 'shown here', '12 patients',
+                   'Figure 3', 'Materials and Methods', '2.1 Sample preparation',
+                   'We observed significant changes in expression levels.']
+
+
+def test_heading_rules(nlp):
+    # lines decided by the rules get the same decision from the tagger
+    for line in RULE_TEST_LINES:
+        stage, decision = utils.heading_rules(line)
+        if stage in ('no_capital', 'numbers'):
+            assert decision == utils.is_heading_tagged(line, nlp), line
+    print('heading_rules ok')
+
+
+def test_par_start_rules(nlp):
+    for line in RULE_TEST_LINES:
+        stage, decision = utils.par_start_rules(line, tokenizer=nlp.tokenizer)
+        if stage == 'few_tokens':
+            assert decision == utils.is_par_start(line, 80, nlp), line
+    print('par_start_rules ok')
+
+
+def test_rule_cascade(nlp):
+    classifier = utils.RuleCascade(nlp, tokenizer=nlp.tokenizer)
+    for line in RULE_TEST_LINES:
+        assert classifier.is_heading(line) == utils.is_heading(line, nlp), line
+        assert classifier.is_par_start(line, 80) == utils.is_par_start(line, 80, nlp), line
+        assert classifier.is_figure_text(line.split()) == utils.is_figure_text(line.split(), nlp)
+    for predicate, stages in classifier.report().items():
+        assert abs(sum(stages.values()) - 1.0) < 1e-6, predicate
+    print('rule_cascade ok')
+
+
+def make_pages(page_lines, first_page_id=1):
+    pages = []
+    for i, lines in enumerate(page_lines):
+        page = Page(first_page_id + i)
+        page.lines = list(lines)
+        pages.append(page)
+    return pages
+
+
+def make_body(i, num_lines=12):
+    # digits are normalized away, so the lines differ in letters
+    letters = 'abcdefghijklmnopqrst'
+    return ['Line {} of the text on page {}.'.format(letters[j], letters[i])
+            for j in range(num_lines)]
+
+
+def test_running_lines_odd_even():
+    # alternating headers are on only half of the pages each
+    pages = make_pages([['Journal of Things' if i % 2 else 'Running Title Here'] + make_body(i)
+                        for i in range(8)])
+    running_lines = RunningLines(pages)
+    assert running_lines.headers == {RunningLines.normalize('Journal of Things'),
+                                     RunningLines.normalize('Running Title Here')}
+    for i, page in enumerate(pages):
+        running_lines.strip(page)
+        assert page.lines == make_body(i), page.lines
+
+
+def test_running_lines_numbers():
+    pages = make_pages([['Page {} of 8'.format(i + 1), 'Received: 2020-03-{:02d}'.format(i + 10)]
+                        + make_body(i) + ['doi:10.1016/j.cell.2020.{}'.format(i + 100), str(i + 1)]
+                        for i in range(8)])
+    running_lines = RunningLines(pages)
+    assert len(running_lines.headers) == 2
+    # the page number itself recurs as '#'
+    assert running_lines.footers == {RunningLines.normalize('doi:10.1016/j.cell.2020.100'),
+                                     RunningLines.normalize('1')}
+    for i, page in enumerate(pages):
+        running_lines.strip(page)
+        assert page.lines == make_body(i), page.lines
+
+
+def test_running_lines_single_page():
+    # nothing recurs on a single page, only the page number is stripped
+    pages = make_pages([['Journal of Things'] + make_body(0) + ['', '1']])
+    running_lines = RunningLines(pages)
+    assert not running_lines.headers and not running_lines.footers
+    running_lines.strip(pages[0])
+    assert pages[0].lines == ['Journal of Things'] + make_body(0), pages[0].lines
+
+
+def test_running_lines_sample_size():
+    # pages 0, 4, 8, 12 and 16 of 20 are sampled
+    page_lines = [['Journal of Things'] + make_body(i) for i in range(20)]
+    for i in range(0, 20, 4):
+        page_lines[i] = ['Sampled Only'] + page_lines[i]
+    key = RunningLines.normalize('Sampled Only')
+    assert key in RunningLines(make_pages(page_lines), sample_size=5).headers
+    assert key not in RunningLines(make_pages(page_lines)).headers
+
+
+def test_running_lines_leading_blanks():
+    pages = make_pages([['', 'Journal of Things', ''] + make_body(i) for i in range(4)]
+                       + [['', ''] + make_body(4)])
+    running_lines = RunningLines(pages)
+    for i, page in enumerate(pages[:4]):
+        running_lines.strip(page)
+        assert page.lines == make_body(i), page.lines
+    # without a header match the leading blank lines are kept
+    running_lines.strip(pages[4])
+    assert pages[4].lines == ['', ''] + make_body(4), pages[4].lines
+
+
+def make_column_boxes(num_cols, title=False):
+    """4 boxes per column on a page spanning 50-540 (BBox y0/y1) with
+    20 wide gutters. The node of each box is its name."""
+    boxes = []
+    if title:
+        boxes.append(BBox(50, 10, 540, 40, 'title'))
+    width = (490 - 20 * (num_cols - 1)) // num_cols
+    for c in range(num_cols):
+        left = 50 + c * (width + 20)
+        for r in range(4):
+            boxes.append(BBox(left, 50 + 50 * r, left + width, 90 + 50 * r,
+                              'c{}_{}'.format(c, r)))
+    return boxes
+
+
+def get_layout_names(clusters):
+    return [[m.node for m in c.members] for c in clusters]
+
+
+def test_find_column_bounds():
+    assert list(find_column_bounds(bboxes_to_array(make_column_boxes(1)))) == []
+    assert list(find_column_bounds(bboxes_to_array(make_column_boxes(2)))) == [295.5]
+    assert list(find_column_bounds(bboxes_to_array(make_column_boxes(3)))) == [210.5, 380.5]
+    # the title is wider than the columns and left out of the projection
+    boxes = bboxes_to_array(make_column_boxes(2, title=True))
+    assert list(find_column_bounds(boxes)) == [295.5]
+
+
+def test_layout_columns():
+    for num_cols in (1, 2, 3):
+        names = get_layout_names(layout_columns(make_column_boxes(num_cols)))
+        assert names == [['c{}_{}'.format(c, r) for r in range(4)]
+                         for c in range(num_cols)], names
+    # a title spanning the columns is read first, a spanning box further
+    # down breaks the columns into bands above and below it
+    boxes = make_column_boxes(2, title=True)
+    boxes.append(BBox(50, 260, 540, 290, 'figure'))
+    boxes.append(BBox(50, 300, 285, 340, 'after0'))
+    boxes.append(BBox(305, 300, 540, 340, 'after1'))
+    names = get_layout_names(layout_columns(boxes))
+    assert names == [['title'], ['c0_0', 'c0_1', 'c0_2', 'c0_3'],
+                     ['c1_0', 'c1_1', 'c1_2', 'c1_3'], ['figure'],
+                     ['after0'], ['after1']], names
+
+
+def make_glove_db(db_file, terms, dim=4):
+    rng = np.random.default_rng(0)
+    conn = sqlite3.connect(db_file)
+    conn.execute("create table glove_vecs (term text primary key, vector blob)")
+    for term in terms:
+        conn.execute("insert into glove_vecs values (?, ?)",
+                     (term, rng.standard_normal(dim).astype(np.float32).tobytes()))
+    conn.commit()
+    conn.close()
+
+
+def test_token_id_features():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, 'glove.db')
+        make_glove_db(db_file, ['unk1', 'cell', 'protein', 'growth', 'medium'])
+        glove_handler = GloveHandler(db_file)
+        train_data = [['cell', 'growth'], ['protein', 'xyzzy']]
+        vocab, embedding_matrix = junk_remover.build_vocab(train_data, glove_handler, gv_dim=4)
+        # the embedded token ids are the vector features of the training terms
+        # (unk1 for the ones without a GloVe vector)
+        X_ids = junk_remover.featurize(train_data, 5, glove_handler, gv_dim=4, vocab=vocab)
+        X_vecs = junk_remover.featurize(train_data, 5, glove_handler, gv_dim=4)
+        assert np.array_equal(embedding_matrix[X_ids], X_vecs)
+
+        # without its Embedding layer a token id model gives the same scores
+        # for the vector features, and uses the GloVe vector of 'medium',
+        # which is not in the training vocabulary
+        rng = np.random.default_rng(1)
+        dense = DenseLayer(rng.standard_normal((5 * 4, 1)).astype(np.float32),
+                           np.zeros(1, dtype=np.float32), sigmoid)
+        model = NumpyModel([EmbeddingLayer(embedding_matrix), FlattenLayer(), dense],
+                           input_shape=(5,))
+        vector_model = junk_remover.drop_embedding_layer(model)
+        assert vector_model.input_shape == (5, 4)
+        assert np.allclose(vector_model.predict(X_vecs), model.predict(X_ids))
+        data = [['medium', 'cell']]
+        X_vecs = junk_remover.featurize(data, 5, glove_handler, gv_dim=4)
+        X_ids = junk_remover.featurize(data, 5, glove_handler, gv_dim=4, vocab=vocab)
+        assert not np.array_equal(embedding_matrix[X_ids], X_vecs)
+        full_vocab, full_matrix = junk_remover.build_vocab(data, glove_handler, gv_dim=4)
+        X_full_ids = junk_remover.featurize(data, 5, glove_handler, gv_dim=4, vocab=full_vocab)
+        assert np.array_equal(full_matrix[X_full_ids], X_vecs)
+        glove_handler.close()
+    print('token_id_features ok')
+
+
 nlp = spacy.load("en_core_web_sm")
 print("loaded spacy.")
 
@@ -63,4 +271,15 @@ print("loaded spacy.")
 # test_is_heading(nlp)
 # test_can_line_be_ignored()
 test_is_mostly_numbers()
+test_heading_rules(nlp)
+test_par_start_rules(nlp)
+test_rule_cascade(nlp)
+test_running_lines_odd_even()
+test_running_lines_numbers()
+test_running_lines_single_page()
+test_running_lines_sample_size()
+test_running_lines_leading_blanks()
+test_find_column_bounds()
+test_layout_columns()
+test_token_id_features()
 